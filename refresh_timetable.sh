@@ -9,6 +9,9 @@
 #
 # Only do anything at most once every few hours (120 min), and even then
 # only download files if their modification date has changed.
+#
+# Finally bring the compiled timetable index (TIMETABLE_INDEX) up to date
+# unless it has been disabled by setting TIMETABLE_INDEX to ''.
 
 set -e
 
@@ -32,8 +35,11 @@ process_section() {
          --silent --show-error \
          "${base}${filename}")
 
-    # Unzip it if it actually changed (or it was new)
-    if [[ ${size} -ne 0 ]]; then
+    # Unzip it if it actually changed (or it was new), unless the
+    # timetable is being read directly from the zip files
+    if [[ ${size} -ne 0 && "${TIMETABLE_SOURCE}" = "zip" ]]; then
+        echo "Section ${section} new or changed"
+    elif [[ ${size} -ne 0 ]]; then
         echo "Section ${section} new or changed - unzipping"
         tmp=$(mktemp -d XXXXXX)
         unzip -q -d "${tmp}" "${filename}"
@@ -51,6 +57,8 @@ process_section() {
 
 base='ftp://ftp.tnds.basemap.co.uk/'
 
+scripts="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null && pwd )/scripts"
+
 if [[ "${TNDS_USERNAME}" = "" || "${TNDS_PASSWORD}" = "" ]]; then
     echo 'Please set TNDS_USERNAME and/or TNDS_PASSWORD in setup_environment' >&2
     exit 1
@@ -79,3 +87,8 @@ done
 touch .last_update
 
 echo 'Timetable files up to date' >&2
+
+if [[ "${TIMETABLE_INDEX-default}" != "" ]]; then
+    echo 'Updating timetable index' >&2
+    "${scripts}/tnds_index.py"
+fi
@@ -25,6 +25,8 @@ def sumarise(day):
     print('Total matched rows: {0}'.format(data['Type'].count()))
     print('Journeys:           {0}'.format(data['Journey_Line'].count()))
     print('Trips:              {0}'.format(data['Trip_Line'].count()))
+    if 'Rejected' in data:
+        print('Rejected trips:     {0}'.format(data['Rejected'].count()))
     print()
 
     type_desc = {
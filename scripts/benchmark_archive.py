@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the consolidated SIRI-VM archive
+
+Given one or more dates, build each day's archive (see
+sirivm_archive.py) from its SIRI-VM files in SIRIVM_PATH into a
+temporary directory, then time collecting the day's trips from the
+JSON files (get_trips.read_trips()) against collecting them from the
+archive (get_trips.archived_trips()), and check that both produce the
+same trips, in the same order, with the same positions. Every stop is
+treated as 'interesting' so that all trips are compared. Exits with
+status 2 if any day's trips differ.
+
+    benchmark_archive.py 2018-10-13 [2018-10-14 ...]
+'''
+
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from get_trips import archived_trips, read_trips
+from sirivm import day_files
+from sirivm_archive import archive_filename, read_archive, write_archive
+from trip import json_default
+from util import LOAD_PATH
+
+logger = logging.getLogger('__name__')
+
+
+class AllStops(object):
+    '''
+    Stand-in for interesting_stops that contains every stop
+    '''
+    def __contains__(self, stop):
+        return True
+
+
+def describe(trips):
+    '''
+    Return a list of (key, finished trip as JSON) for a dictionary of
+    partial trips, in the dictionary's order
+    '''
+
+    result = []
+    for key, trip in trips.items():
+        trip.finish()
+        result.append((key, json.dumps(trip.as_dict(), sort_keys=True, default=json_default)))
+    return result
+
+
+def main():
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    try:
+        days = [datetime.datetime.strptime(arg, '%Y-%m-%d').date() for arg in sys.argv[1:]]
+    except ValueError:
+        days = []
+    if not days:
+        logger.error('Usage: %s YYYY-MM-DD [YYYY-MM-DD ...]', sys.argv[0])
+        sys.exit(1)
+
+    interesting_stops = AllStops()
+    json_total = archive_total = 0.0
+    differences = 0
+
+    with tempfile.TemporaryDirectory() as archive_path:
+
+        for day in days:
+
+            filenames = day_files(LOAD_PATH, day)
+            if not filenames:
+                logger.warning('No SIRI-VM files for %s', day)
+                continue
+
+            filename = archive_filename(archive_path, day)
+            records = write_archive(filename, filenames)
+
+            start = time.perf_counter()
+            from_json = read_trips(filenames, interesting_stops, workers=1)
+            json_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            from_archive = archived_trips(read_archive(filename, filenames), interesting_stops)
+            archive_time = time.perf_counter() - start
+
+            expected = describe(from_json)
+            actual = describe(from_archive)
+            if actual != expected:
+                differences += 1
+                logger.error('%s: trips differ (%s from the files, %s from the archive)',
+                             day, len(expected), len(actual))
+                for (key, a), (_, b) in zip(expected, actual):
+                    if a != b:
+                        logger.error('First difference: %s', key)
+                        break
+
+            logger.info('%s: %s files, %s records, %s trips, %s bytes archived, json %.3fs, archive %.3fs',
+                        day, len(filenames), records, len(expected), os.path.getsize(filename),
+                        json_time, archive_time)
+
+            json_total += json_time
+            archive_total += archive_time
+
+    logger.info('Total: %s days, json %.3fs, archive %.3fs (x%.1f)',
+                len(days), json_total, archive_total,
+                json_total / archive_total if archive_total else 0)
+
+    if differences:
+        logger.error('Trips differ on %s days', differences)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark TNDS journey extraction
+
+Given a date and one or more TNDS files, time the original
+get_journeys.process() implementation (which located each journey's
+Service, Operator, JourneyPattern and JourneyPatternSections with XPath
+searches of the whole document) against the current single-pass one,
+and check that both produce the same journeys. Every stop is treated as
+'interesting' so that all journeys running on the day are expanded.
+
+    benchmark_journeys.py 2018-10-13 /media/tfc/tnds/sections/EA/*.xml
+'''
+
+import datetime
+import logging
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import isodate
+
+import txc_helper
+from get_journeys import NS, UK_LOCAL, process
+
+logger = logging.getLogger('__name__')
+
+
+class AllStops(object):
+    '''
+    Stand-in for interesting_stops that contains every stop
+    '''
+    def __contains__(self, stop):
+        return True
+
+
+def reference_process(filename, day, interesting_stops):
+    '''
+    The original implementation of get_journeys.process()
+    '''
+
+    service_cache = {}
+
+    tree = ET.parse(filename).getroot()
+
+    journeys = []
+
+    for vehicle_journey in tree.findall('n:VehicleJourneys/n:VehicleJourney', NS):
+
+        service_ref = vehicle_journey.find('n:ServiceRef', NS).text
+        if service_ref in service_cache:
+            service = service_cache[service_ref]
+        else:
+            service = tree.find("n:Services/n:Service[n:ServiceCode='%s']" % service_ref, NS)
+            service_cache[service_ref] = service
+
+        service_start = service.find('n:OperatingPeriod/n:StartDate', NS)
+        service_start_date = datetime.datetime.strptime(service_start.text, '%Y-%m-%d').date()
+        if day < service_start_date:
+            continue
+
+        service_end = service.find('n:OperatingPeriod/n:EndDate', NS)
+        if service_end is not None:
+            service_end_date = datetime.datetime.strptime(service_end.text, '%Y-%m-%d').date()
+            if day > service_end_date:
+                continue
+
+        service_op_element = service.find('n:OperatingProfile', NS)
+        service_op = txc_helper.OperatingProfile.from_et(service_op_element)
+
+        journey_op_element = vehicle_journey.find('n:OperatingProfile', NS)
+        journey_op = txc_helper.OperatingProfile.from_et(journey_op_element)
+        journey_op.defaults_from(service_op)
+
+        if not journey_op.should_show(day):
+            continue
+
+        operator_id = service.find('n:RegisteredOperatorRef', NS).text
+        operator = tree.find('n:Operators/n:Operator[@id="%s"]' % operator_id, NS)
+
+        departure_time = vehicle_journey.find('n:DepartureTime', NS).text
+        departure_time_time = datetime.datetime.strptime(departure_time, '%H:%M:%S').time()
+        departure_timestamp = UK_LOCAL.localize(datetime.datetime.combine(day, departure_time_time))
+
+        journey_pattern_id = vehicle_journey.find('n:JourneyPatternRef', NS).text
+        journey_pattern = tree.find(
+            'n:Services/n:Service/n:StandardService/n:JourneyPattern[@id="%s"]' % journey_pattern_id, NS)
+
+        journey_pattern_section_ids = []
+        journey_stops = []
+        time = departure_timestamp
+        for journey_pattern_section_id_element in journey_pattern.findall('n:JourneyPatternSectionRefs', NS):
+
+            journey_pattern_section_id = journey_pattern_section_id_element.text
+            journey_pattern_section_ids.append(journey_pattern_section_id)
+            journey_pattern_section = tree.find(
+                'n:JourneyPatternSections/n:JourneyPatternSection[@id="%s"]' % journey_pattern_section_id, NS)
+
+            for link in journey_pattern_section.findall('n:JourneyPatternTimingLink', NS):
+
+                From = link.find('n:From', NS)
+                stop = {
+                    'StopPointRef': From.find('n:StopPointRef', NS).text,
+                    'Order': From.get('SequenceNumber'),
+                    'Activity': From.find('n:Activity', NS).text,
+                    'TimingStatus': From.find('n:TimingStatus', NS).text,
+                    'time': time.replace(microsecond=0).isoformat()
+                }
+
+                run_time = link.find('n:RunTime', NS).text
+                stop['run_time'] = run_time
+                run_time_duration = isodate.parse_duration(run_time)
+                time += run_time_duration
+
+                to = link.find('n:To', NS)
+                wait_time = to.find('n:WaitTime')
+                if wait_time is not None:
+                    stop['wait_time'] = wait_time.text
+                    wait_time_duration = isodate.parse_duration(wait_time.text)
+                    time += wait_time_duration
+
+                journey_stops.append(stop)
+
+            stop = {
+                'StopPointRef': to.find('n:StopPointRef', NS).text,
+                'Order': to.get('SequenceNumber'),
+                'Activity': to.find('n:Activity', NS).text,
+                'TimingStatus': to.find('n:TimingStatus', NS).text,
+                'time': time.replace(microsecond=0).isoformat()
+            }
+
+            journey_stops.append(stop)
+
+        if (journey_stops[0]['StopPointRef'] not in interesting_stops and
+           journey_stops[-1]['StopPointRef'] not in interesting_stops):
+            continue
+
+        journey = {
+            'file': filename,
+            'PrivateCode': vehicle_journey.find('n:PrivateCode', NS).text,
+            'VehicleJourneyCode': vehicle_journey.find('n:VehicleJourneyCode', NS).text,
+            'DepartureTime': departure_timestamp.replace(microsecond=0).isoformat(),
+            'Service': {
+                'PrivateCode': service.find('n:PrivateCode', NS).text,
+                'ServiceCode': service.find('n:ServiceCode', NS).text,
+                'Description': service.find('n:Description', NS).text,
+                'LineName': service.find('n:Lines/n:Line/n:LineName', NS).text,
+                'OperatorCode': operator.find('n:OperatorCode', NS).text,
+                'OperatorName': operator.find('n:OperatorNameOnLicence', NS).text,
+            },
+            'JourneyPatternId': journey_pattern_id,
+            'Direction': journey_pattern.find('n:Direction', NS).text,
+            'JourneyPatternSectionIds': journey_pattern_section_ids,
+            'stops': journey_stops,
+        }
+        journeys.append(journey)
+
+    return journeys
+
+
+def main():
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    try:
+        day = datetime.datetime.strptime(sys.argv[1], '%Y-%m-%d').date()
+    except (IndexError, ValueError):
+        logger.error('Usage: %s YYYY-MM-DD FILE [FILE ...]', sys.argv[0])
+        sys.exit(1)
+
+    interesting_stops = AllStops()
+    reference_total = current_total = 0.0
+    journey_counter = 0
+
+    for filename in sys.argv[2:]:
+
+        start = time.perf_counter()
+        reference = reference_process(filename, day, interesting_stops)
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        current = process(filename, day, interesting_stops)
+        current_time = time.perf_counter() - start
+
+        if current != reference:
+            logger.error('%s: results differ', filename)
+
+        logger.info('%s: %s journeys, reference %.3fs, current %.3fs',
+                    filename, len(current), reference_time, current_time)
+
+        reference_total += reference_time
+        current_total += current_time
+        journey_counter += len(current)
+
+    logger.info('Total: %s files, %s journeys, reference %.3fs, current %.3fs (x%.1f)',
+                len(sys.argv) - 2, journey_counter, reference_total, current_total,
+                reference_total / current_total if current_total else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark matching trips to journeys
+
+Given a day for which trips-<yyyy>-<mm>-<dd>.json and
+journeys-<yyyy>-<mm>-<dd>.json exist in the current directory, time
+the original merge.do_merge() implementation (which only matched
+exactly and took the groups off the front of sorted lists) against
+the current one with no tolerance, and check that both produce the
+same results. Then report how many more groups the current one
+matches with a departure time tolerance of TOLERANCE seconds
+(default 120).
+
+Then time merge.fuzzy_pairs() against the original version (which
+considered every trip within the tolerance of each journey) on the
+groups that don't match exactly, with tolerances of 1, 10 and 100
+times TOLERANCE, to show how each scales as the tolerance widens.
+
+Without a day, or after the above, the same comparison is made on
+synthetic keys on a single route, checking that both versions make
+the same pairs:
+
+  * 'Dense': DENSE_COUNT trips and as many journeys, departing at
+    random through the day
+  * 'Offset': journeys departing at random and a trip for each,
+    departing OFFSET seconds (plus up to a minute) after it, so every
+    trip is later than its journey by more than the spacing between
+    departures. With a wide tolerance every journey's nearest trips
+    are then ones that other journeys want too. This is run for
+    OFFSET_COUNTS journeys at 100 times TOLERANCE, to show how the
+    time grows with their number.
+
+Exits with status 2 if any of the results differ.
+
+    benchmark_merge.py [2018-10-13] [TOLERANCE]
+'''
+
+import bisect
+import collections
+import datetime
+import logging
+import random
+import sys
+import time
+
+from merge import (
+    STOP_PENALTY, departure_seconds, do_merge, fuzzy_pairs, load_journeys,
+    load_stop_classes, load_trips
+)
+from util import MERGE_EQUIVALENT_STOPS, get_stop_clusters
+
+logger = logging.getLogger('__name__')
+
+# The number of synthetic trips and journeys in the dense case
+DENSE_COUNT = 5000
+
+# How much later than their journeys the trips in the offset case
+# depart (seconds), and the numbers of journeys to try
+OFFSET = 600
+OFFSET_COUNTS = (500, 1000, 2000, 4000)
+
+# The day used for synthetic keys if none is given
+SYNTHETIC_DAY = datetime.date(2018, 10, 13)
+
+
+def reference_do_merge(trips, journeys):
+    '''
+    The original implementation of merge.do_merge(), which only
+    matched identical departure time, origin and destination
+    '''
+
+    # Group trips by OriginAimedDepartureTime/OriginRef/DestinationRef
+    # and create a sorted list of keys
+    trip_index = collections.defaultdict(list)
+    trip_list = []
+    for trip in trips:
+        key = (
+            trip['OriginAimedDepartureTime'],
+            trip['OriginRef'],
+            trip['DestinationRef']
+        )
+        trip_index[key].append(trip)
+    trip_list = sorted(trip_index.keys())
+    logger.info('Grouped %s trips into %s groups', len(trips), len(trip_list))
+
+    # Dito for journeys, grouped by DepartureTime and first and last stop
+    journey_index = collections.defaultdict(list)
+    journey_list = []
+    for journey in journeys:
+        key = (
+            journey['DepartureTime'],
+            journey['stops'][0]['StopPointRef'],
+            journey['stops'][-1]['StopPointRef']
+        )
+        journey_index[key].append(journey)
+    journey_list = sorted(journey_index.keys())
+    logger.info('Grouped %s journeys into %s groups', len(journeys), len(journey_list))
+
+    # Merge trips and journeys into one list that has one element per distinct
+    # departure time/origin/destination and whose first column contains a
+    # (possibly empty) list of trips and whose second column contains a
+    # (possibly empty) list of journeys
+    results = []
+    while trip_list and journey_list:
+        if trip_list[0] < journey_list[0]:
+            results.append({
+                'trips': trip_index[trip_list.pop(0)],
+                'journeys': []
+            })
+        elif trip_list[0] > journey_list[0]:
+            results.append({
+                'trips': [],
+                'journeys': journey_index[journey_list.pop(0)]
+            })
+        else:
+            results.append({
+                'trips': trip_index[trip_list.pop(0)],
+                'journeys': journey_index[journey_list.pop(0)]
+            })
+    while trip_list:
+        results.append({
+            'trips': trip_index[trip_list.pop(0)],
+            'journeys': []
+        })
+    while journey_list:
+        results.append({
+            'trips': [],
+            'journeys': journey_index[journey_list.pop(0)]
+        })
+
+    logger.info('Created %s merged records', len(results))
+
+    return results
+
+
+def reference_fuzzy_pairs(trip_keys, journey_keys, tolerance, stop_class):
+    '''
+    The original implementation of merge.fuzzy_pairs(), which scored
+    every trip within 'tolerance' of each journey
+    '''
+
+    def class_of(stop):
+        return stop_class.get(stop, stop)
+
+    index = collections.defaultdict(list)
+    for key in trip_keys:
+        index[(class_of(key[1]), class_of(key[2]))].append((departure_seconds(key[0]), key))
+    times = {}
+    for classes, bucket in index.items():
+        bucket.sort()
+        times[classes] = [time for time, _ in bucket]
+
+    candidates = []
+    for key in journey_keys:
+        classes = (class_of(key[1]), class_of(key[2]))
+        if classes not in index:
+            continue
+        time = departure_seconds(key[0])
+        first = bisect.bisect_left(times[classes], time - tolerance)
+        last = bisect.bisect_right(times[classes], time + tolerance)
+        for trip_time, trip_key in index[classes][first:last]:
+            score = (abs(trip_time - time) +
+                     STOP_PENALTY * ((trip_key[1] != key[1]) + (trip_key[2] != key[2])))
+            candidates.append((score, key, trip_key))
+
+    candidates.sort()
+    pairs = []
+    paired = set()
+    for score, journey_key, trip_key in candidates:
+        if journey_key not in paired and trip_key not in paired:
+            pairs.append((journey_key, trip_key))
+            paired.add(journey_key)
+            paired.add(trip_key)
+
+    return pairs
+
+
+def synthetic_key(day, second):
+    '''
+    Return a synthetic group key departing 'second' seconds into 'day'
+    '''
+    midnight = datetime.datetime.combine(day, datetime.time()).replace(tzinfo=datetime.timezone.utc)
+    return ((midnight + datetime.timedelta(seconds=second)).isoformat(),
+            '0500SYNTH001', '0500SYNTH002')
+
+
+def dense_keys(day, count):
+    '''
+    Return 'count' synthetic trip keys and as many journey keys, all
+    distinct, departing at random times on 'day'
+    '''
+    seconds = random.sample(range(24 * 60 * 60), count * 2)
+    return ([synthetic_key(day, second) for second in sorted(seconds[:count])],
+            [synthetic_key(day, second) for second in sorted(seconds[count:])])
+
+
+def offset_keys(day, count):
+    '''
+    Return 'count' synthetic trip keys and as many journey keys, each
+    trip departing OFFSET seconds and up to a minute after a journey
+    '''
+    seconds = sorted(random.sample(range(0, 24 * 60 * 60, 2), count))
+    return ([synthetic_key(day, second + OFFSET + 2 * random.randrange(30) + 1) for second in seconds],
+            [synthetic_key(day, second) for second in seconds])
+
+
+def compare_fuzzy(label, trip_keys, journey_keys, tolerances, stop_class):
+    '''
+    Time reference_fuzzy_pairs() against merge.fuzzy_pairs() for each
+    of 'tolerances'. Return the number of tolerances for which they
+    made different pairs.
+    '''
+
+    differences = 0
+    for tolerance in tolerances:
+
+        start = time.perf_counter()
+        reference_pairs = reference_fuzzy_pairs(trip_keys, journey_keys, tolerance, stop_class)
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        current_pairs = fuzzy_pairs(trip_keys, journey_keys, tolerance, stop_class)
+        current_time = time.perf_counter() - start
+
+        logger.info('%s, %s trips, %s journeys, tolerance %ss: reference %s pairs %.3fs, '
+                    'current %s pairs %.3fs, %s pairs the same', label, len(trip_keys),
+                    len(journey_keys), tolerance, len(reference_pairs), reference_time,
+                    len(current_pairs), current_time,
+                    len(set(reference_pairs) & set(current_pairs)))
+
+        if set(reference_pairs) != set(current_pairs):
+            logger.error('%s, tolerance %ss: pairs differ', label, tolerance)
+            differences += 1
+
+    return differences
+
+
+def compare_synthetic(day, tolerance):
+    '''
+    Run the synthetic comparisons (see above). Return the number that
+    made different pairs.
+    '''
+
+    random.seed(day.toordinal())
+    differences = compare_fuzzy('Dense', *dense_keys(day, DENSE_COUNT),
+                                [tolerance * factor for factor in (1, 10, 100)], {})
+    for count in OFFSET_COUNTS:
+        differences += compare_fuzzy('Offset', *offset_keys(day, count), [tolerance * 100], {})
+    return differences
+
+
+def summary(results):
+    return (sum(1 for r in results if r['trips'] and r['journeys']),
+            sum(1 for r in results if r['trips'] and not r['journeys']),
+            sum(1 for r in results if r['journeys'] and not r['trips']))
+
+
+def main():
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    args = sys.argv[1:]
+    try:
+        day = datetime.datetime.strptime(args.pop(0), '%Y-%m-%d').date() if args and '-' in args[0] else None
+        tolerance = int(args[0]) if args else 120
+    except ValueError:
+        logger.error('Usage: %s [YYYY-MM-DD] [TOLERANCE]', sys.argv[0])
+        sys.exit(1)
+
+    differences = 0
+
+    if day is not None:
+        differences += compare_day(day, tolerance)
+
+    differences += compare_synthetic(day or SYNTHETIC_DAY, tolerance)
+
+    if differences:
+        sys.exit(2)
+
+
+def compare_day(day, tolerance):
+    '''
+    Run the comparisons on the day's trips and journeys (see above).
+    Return 1 if the exact matches differ, 0 if not.
+    '''
+
+    trips = load_trips(day)['trips']
+    journeys = load_journeys(day)['journeys']
+
+    start = time.perf_counter()
+    reference = reference_do_merge(trips, journeys)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    current = do_merge(trips, journeys, tolerance=0, stop_class={})
+    current_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fuzzy = do_merge(trips, journeys, tolerance=tolerance)
+    fuzzy_time = time.perf_counter() - start
+
+    same = reference == current
+    if not same:
+        logger.error('Results differ: reference %s records, current %s',
+                     len(reference), len(current))
+
+    logger.info('%s trips, %s journeys: reference %.3fs, current %.3fs, '
+                'with tolerance %ss %.3fs', len(trips), len(journeys),
+                reference_time, current_time, tolerance, fuzzy_time)
+    logger.info('Matched/trip only/journey only: exact %s/%s/%s, with tolerance %s/%s/%s',
+                *(summary(current) + summary(fuzzy)))
+
+    # The groups left over after exact matching, as do_merge() finds them
+    trip_keys = {(trip['OriginAimedDepartureTime'], trip['OriginRef'], trip['DestinationRef'])
+                 for trip in trips}
+    journey_keys = {(journey['DepartureTime'], journey['stops'][0]['StopPointRef'],
+                     journey['stops'][-1]['StopPointRef']) for journey in journeys}
+    stop_class = load_stop_classes(MERGE_EQUIVALENT_STOPS, get_stop_clusters())
+
+    # Real stop names make ties in score likely, which the two versions
+    # may break differently, so differences here are only reported
+    compare_fuzzy('Unmatched groups', sorted(trip_keys - journey_keys),
+                  sorted(journey_keys - trip_keys),
+                  [tolerance * factor for factor in (1, 10, 100)], stop_class)
+
+    return 0 if same else 1
+
+if __name__ == '__main__':
+    main()
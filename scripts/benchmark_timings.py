@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark derivation of trip departure and arrival timings
+
+Given one or more trips-<yyyy>-<mm>-<dd>.json files as emitted by
+get_trips.py, time the original get_trips.derive_timings()
+implementation (which walked through each trip's positions in turn,
+calculating the distance to the origin and destination stops for
+each) against the current array-based one, and check that both find
+the same departure and arrival positions.
+
+Without files, or after them, the same is done for GENERATED_COUNT
+generated trips between random stops near Cambridge. Their positions
+start some way before, at or after the origin stop, may loiter near
+it or come back to it, and end at, near or well short of the
+destination stop. A few have a stop with missing or unusable
+coordinates, and a few have a single position at, near or away from
+either stop, so the cases that the array-based version handles
+differently from the original (stops that are nowhere, the fallback
+to the final position and trips that start and end in one row) are
+all covered.
+
+Exits with status 2 if any of the results differ.
+
+    benchmark_timings.py [trips-2018-10-13.json ...]
+'''
+
+import json
+import logging
+import math
+import random
+import sys
+import time
+
+from haversine import haversine
+import numpy
+
+from get_trips import derive_timings
+from spatial import stop_position
+from trip import TRIP_FIELDS, Trip
+
+logger = logging.getLogger('__name__')
+
+# The number of generated trips
+GENERATED_COUNT = 20000
+
+# Roughly where the generated stops are, and the size of a degree of
+# latitude and of longitude there (metres)
+GENERATED_CENTRE = (52.2, 0.12)
+METRES_PER_DEGREE = (111200.0, 111200.0 * math.cos(math.radians(GENERATED_CENTRE[0])))
+
+
+def reference_derive_timings(trips):
+    '''
+    The original, position by position, implementation of
+    get_trips.derive_timings()
+
+    The original failed on a stop without coordinates, which now
+    counts as being infinitely far from every position.
+    '''
+
+    logger.info('Deriving timings for %s trips', len(trips))
+
+    threshold = 50
+
+    for trip in trips:
+
+        logger.debug('')
+        logger.debug('Processing %s to %s at %s', trip['OriginRef'],
+                     trip['DestinationRef'], trip['OriginAimedDepartureTime'])
+
+        origin = stop_position(trip['OriginStop'])
+        destination = stop_position(trip['DestinationStop'])
+
+        departure_state = 'before'
+        arrival_state = 'before'
+        departure_position = arrival_position = None
+
+        for row, here in enumerate(zip(trip.latitude.tolist(), trip.longitude.tolist())):
+
+            logger.debug('')
+            logger.debug('Processing position %s', row)
+            logger.debug('initial origin state %s; destination state %s', departure_state, arrival_state)
+
+            origin_distance = haversine(here, origin) * 1000 if origin else math.inf  # in meters
+
+            logger.debug('Origin distance %s', origin_distance)
+
+            if departure_state == 'before' and origin_distance < threshold:
+                departure_state = 'at'
+                logger.debug('Departure state transition before --> at')
+            elif departure_state == 'at' and origin_distance > threshold:
+                departure_position = row - 1
+                departure_state = 'after'
+                logger.debug('Departure state transition at --> after')
+
+            destination_distance = haversine(here, destination) * 1000 if destination else math.inf  # in meters
+
+            logger.debug('Destination distance %s', destination_distance)
+
+            if arrival_state == 'before' and destination_distance < threshold:
+                arrival_state = 'at'
+                arrival_position = row
+                logger.debug('Arrival state transition before --> at')
+
+            logger.debug('Final origin state %s; destination state %s', departure_state, arrival_state)
+
+        # Try a bit harder if we still don't have an arrival_position - use
+        # the very last position if it's within threshold * 4
+        if arrival_position is None:
+            final = (float(trip.latitude[-1]), float(trip.longitude[-1]))
+            if destination and (haversine(final, destination) * 1000) < (threshold * 4):
+                arrival_position = len(trip) - 1
+                logger.debug('Using final position for arrival')
+
+        logger.debug('Departure row %s; arrival row %s', departure_position, arrival_position)
+        logger.debug('')
+
+        trip['departure_position'] = departure_position
+        trip['arrival_position'] = arrival_position
+
+
+def offset(stop, north, east):
+    '''
+    Return the (latitude, longitude) 'north' and 'east' metres from
+    'stop'
+    '''
+    return (stop[0] + north / METRES_PER_DEGREE[0], stop[1] + east / METRES_PER_DEGREE[1])
+
+
+def near(stop, low, high):
+    '''
+    Return a random (latitude, longitude) between 'low' and 'high'
+    metres from 'stop'
+    '''
+    distance = random.uniform(low, high)
+    angle = random.uniform(0, 2 * math.pi)
+    return offset(stop, distance * math.cos(angle), distance * math.sin(angle))
+
+
+def generated_stop(position):
+    '''
+    Return a stop record at 'position', occasionally with missing or
+    unusable coordinates
+    '''
+    choice = random.random()
+    if choice < 0.02:
+        return None
+    if choice < 0.04:
+        return {'latitude': None, 'longitude': None}
+    if choice < 0.06:
+        return {'latitude': '', 'longitude': str(position[1])}
+    return {'latitude': str(position[0]), 'longitude': str(position[1])}
+
+
+def generated_positions(origin, destination):
+    '''
+    Return a list of random (latitude, longitude) positions for a trip
+    from 'origin' to 'destination' (see above)
+    '''
+
+    if random.random() < 0.1:
+        return [random.choice((near(origin, 0, 49), near(origin, 51, 300),
+                               near(destination, 0, 49), near(destination, 51, 199),
+                               near(destination, 201, 1000)))]
+
+    positions = []
+
+    # Before the origin, or starting at or after it
+    for _ in range(random.choice((0, 0, 1, 3))):
+        positions.append(near(origin, 60, 500))
+    for _ in range(random.choice((0, 1, 1, 2, 5))):
+        positions.append(near(origin, 0, 49))
+        if random.random() < 0.1:
+            positions.append(near(origin, 51, 80))
+
+    # On the way, perhaps back past the origin
+    for _ in range(random.randrange(1, 30)):
+        fraction = random.random()
+        positions.append(near((origin[0] + (destination[0] - origin[0]) * fraction,
+                               origin[1] + (destination[1] - origin[1]) * fraction), 0, 100))
+        if random.random() < 0.02:
+            positions.append(near(origin, 0, 49))
+
+    # At the destination, near it, or short of it
+    choice = random.random()
+    if choice < 0.5:
+        for _ in range(random.randrange(1, 4)):
+            positions.append(near(destination, 0, 49))
+    elif choice < 0.75:
+        positions.append(near(destination, 51, 199))
+    else:
+        positions.append(near(destination, 201, 1000))
+    for _ in range(random.choice((0, 0, 2))):
+        positions.append(near(destination, 51, 300))
+
+    return positions
+
+
+def generated_trips(count):
+    '''
+    Return 'count' Trips made from generated positions
+    '''
+
+    random.seed(count)
+    trips = []
+    for n in range(count):
+        origin = near(GENERATED_CENTRE, 0, 10000)
+        destination = near(origin, 300, 20000)
+        positions = generated_positions(origin, destination)
+        fields = {field: '' for field in TRIP_FIELDS}
+        fields.update(OriginRef='0500GEN{:05d}'.format(n), DestinationRef='0500GEN{:05d}'.format(n + 1),
+                      OriginAimedDepartureTime='2018-10-13T{:02d}:{:02d}:00+01:00'.format(
+                          n // 60 % 24, n % 60))
+        trip = Trip.from_columns(
+            fields,
+            numpy.array([latitude for latitude, _ in positions], dtype=numpy.float64),
+            numpy.array([longitude for _, longitude in positions], dtype=numpy.float64),
+            numpy.arange(len(positions), dtype=numpy.int64) * 30,
+            numpy.zeros(len(positions), dtype=numpy.int16),
+            numpy.zeros(len(positions), dtype=numpy.int32))
+        trip.OriginStop = generated_stop(origin)
+        trip.DestinationStop = generated_stop(destination)
+        trips.append(trip)
+    return trips
+
+
+def compare(label, trips):
+    '''
+    Time reference_derive_timings() against derive_timings() on
+    'trips'. Return the two times and the number of trips for which
+    they differ.
+    '''
+
+    start = time.perf_counter()
+    reference_derive_timings(trips)
+    reference_time = time.perf_counter() - start
+    reference = [(trip.departure_position, trip.arrival_position) for trip in trips]
+
+    for trip in trips:
+        trip.departure_position = trip.arrival_position = None
+
+    start = time.perf_counter()
+    derive_timings(trips)
+    current_time = time.perf_counter() - start
+    current = [(trip.departure_position, trip.arrival_position) for trip in trips]
+
+    differences = 0
+    for trip, expected, found in zip(trips, reference, current):
+        if expected != found:
+            logger.error('%s to %s at %s: reference %s, current %s',
+                         trip.OriginRef, trip.DestinationRef,
+                         trip.OriginAimedDepartureTime, expected, found)
+            differences += 1
+
+    logger.info('%s: %s trips, %s with a departure, %s with an arrival, '
+                'reference %.3fs, current %.3fs', label, len(trips),
+                sum(departure is not None for departure, _ in current),
+                sum(arrival is not None for _, arrival in current),
+                reference_time, current_time)
+
+    return reference_time, current_time, differences
+
+
+def main():
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    if any(arg.startswith('-') for arg in sys.argv[1:]):
+        logger.error('Usage: %s [TRIPS_FILE ...]', sys.argv[0])
+        sys.exit(1)
+
+    reference_total = current_total = 0.0
+    trip_counter = differences = 0
+
+    for filename in sys.argv[1:]:
+
+        with open(filename, 'r', newline='') as jsonfile:
+            trips = [Trip.from_dict(trip) for trip in json.load(jsonfile)['trips']]
+
+        reference_time, current_time, file_differences = compare(filename, trips)
+
+        reference_total += reference_time
+        current_total += current_time
+        trip_counter += len(trips)
+        differences += file_differences
+
+    if trip_counter:
+        logger.info('Total: %s trips, %s differences, reference %.3fs, current %.3fs (x%.1f)',
+                    trip_counter, differences, reference_total, current_total,
+                    reference_total / current_total if current_total else 0)
+
+    generated_differences = compare('Generated', generated_trips(GENERATED_COUNT))[2]
+    logger.info('Generated: %s differences', generated_differences)
+
+    if differences or generated_differences:
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+'''
+Check the stop lookups made by util.prefetch_stops() and util.lookup()
+
+Replaces util's keep-alive requests.Session with a stand-in that
+answers from a small set of known stops (slowly, so that
+LOOKUP_WORKERS requests really are in progress at once), fails for
+some others with an HTTP error, a connection error or a response
+that isn't JSON, and counts the URLs it's asked for. Then checks
+that:
+
+  * each stop is requested once however often it's asked for, and
+    stops that fail end up as {} and in util._failed_stops
+  * failed stops aren't requested again, by prefetch_stops() or by
+    lookup(), and stops that were retrieved come from the stop store
+  * with OFFLINE set, neither the session nor the API client is used
+    at all, stored stops are still found and others end up as {}
+
+Uses a temporary stop store and needs no API_TOKEN or network access.
+Exits with status 2 if any check fails.
+
+    check_stop_fetch.py
+'''
+
+import collections
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import requests
+
+# util insists on one or the other when it's imported
+os.environ.setdefault('API_TOKEN', 'check_stop_fetch')
+
+import util  # noqa: E402
+
+logger = logging.getLogger('__name__')
+
+# Stops the stand-in session knows about
+KNOWN_STOPS = ['0500CCITY{:03d}'.format(n) for n in range(40)]
+
+# Stops for which it fails, and how
+HTTP_ERROR_STOPS = ['0500CCITY9{:02d}'.format(n) for n in range(5)]
+CONNECTION_ERROR_STOPS = ['0500CCITY8{:02d}'.format(n) for n in range(5)]
+INVALID_STOPS = ['0500CCITY7{:02d}'.format(n) for n in range(5)]
+
+FAILING_STOPS = HTTP_ERROR_STOPS + CONNECTION_ERROR_STOPS + INVALID_STOPS
+
+# A stop that's already in stops1, so should never be asked for
+STOPS1_STOP = '0500CCITY999'
+
+
+class StubResponse(object):
+    '''
+    Enough of a requests.Response for util._fetch_stop()
+    '''
+
+    def __init__(self, url, status, body):
+        self.url = url
+        self.status = status
+        self.body = body
+
+    def raise_for_status(self):
+        if self.status != 200:
+            raise requests.HTTPError('%s for %s' % (self.status, self.url))
+
+    def json(self):
+        if self.body is None:
+            raise ValueError('Expecting value')
+        return self.body
+
+
+class StubSession(object):
+    '''
+    Stand-in for util's requests.Session that counts the stops it's
+    asked for
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+
+    def get(self, url, timeout=None):
+        stop = urllib.parse.unquote(url.rstrip('/').rsplit('/', 1)[-1])
+        with self.lock:
+            self.requests[stop] += 1
+        time.sleep(0.01)
+        if stop in CONNECTION_ERROR_STOPS:
+            raise requests.ConnectionError('Connection refused')
+        if stop in INVALID_STOPS:
+            return StubResponse(url, 200, None)
+        if stop in KNOWN_STOPS:
+            return StubResponse(url, 200, {'atco_code': stop, 'common_name': 'Stop %s' % stop,
+                                           'latitude': 52.2, 'longitude': 0.12})
+        return StubResponse(url, 404, None)
+
+
+class StubClient(object):
+    '''
+    Stand-in for a coreapi client that counts its uses
+    '''
+
+    def __init__(self):
+        self.uses = 0
+
+    def action(self, schema, action, params=None):
+        self.uses += 1
+        return {}
+
+
+class NoNetwork(object):
+    '''
+    Stand-in for requests.Session and util's session that fails if
+    used
+    '''
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        raise AssertionError('Network used while OFFLINE is set (%s)' % name)
+
+
+def check(results, description, passed):
+    '''
+    Log the result of a check and add it to 'results'
+    '''
+    if passed:
+        logger.info('OK: %s', description)
+    else:
+        logger.error('FAILED: %s', description)
+    results.append(passed)
+
+
+def check_online(results, session):
+
+    # Ask for every stop several times over, and for some that are
+    # already known
+    wanted = (KNOWN_STOPS + FAILING_STOPS + [STOPS1_STOP]) * 3
+    stops1 = {STOPS1_STOP: {'atco_code': STOPS1_STOP}}
+    stops2 = {}
+    util.prefetch_stops(wanted, stops1, stops2)
+
+    check(results, 'stops already known aren\'t requested',
+          session.requests[STOPS1_STOP] == 0)
+    check(results, 'every other stop is requested exactly once',
+          set(session.requests) == set(KNOWN_STOPS + FAILING_STOPS) and
+          set(session.requests.values()) == {1})
+    check(results, 'retrieved stops are returned',
+          all(stops2[stop]['atco_code'] == stop for stop in KNOWN_STOPS))
+    check(results, 'failed stops are returned as {}',
+          all(stops2[stop] == {} for stop in FAILING_STOPS))
+    check(results, 'failed stops are remembered',
+          set(FAILING_STOPS) <= util._failed_stops and
+          not set(KNOWN_STOPS) & util._failed_stops)
+
+    # Again, as a later stage of the pipeline would with its own
+    # stops2
+    session.requests.clear()
+    stops2 = {}
+    util.prefetch_stops(wanted, stops1, stops2)
+    check(results, 'nothing is requested a second time', not session.requests)
+    check(results, 'retrieved stops come from the stop store',
+          all(stops2[stop]['atco_code'] == stop for stop in KNOWN_STOPS))
+    check(results, 'failed stops are still {}',
+          all(stops2[stop] == {} for stop in FAILING_STOPS))
+
+    client = StubClient()
+    check(results, 'lookup() of a failed stop returns {} without using the API',
+          all(util.lookup(client, None, stop, {}, {}) == {} for stop in FAILING_STOPS) and
+          client.uses == 0 and not session.requests)
+
+
+def check_offline(results):
+
+    util.OFFLINE = True
+    util._session = NoNetwork()
+    requests_session = requests.Session
+    requests.Session = NoNetwork
+    try:
+        new_stops = ['0500CCITY6{:02d}'.format(n) for n in range(5)]
+
+        stops2 = {}
+        try:
+            util.prefetch_stops(KNOWN_STOPS + new_stops, {}, stops2)
+            network = False
+        except AssertionError as e:
+            logger.error('%s', e)
+            network = True
+        check(results, 'OFFLINE prefetch_stops() doesn\'t use the network', not network)
+        check(results, 'OFFLINE prefetch_stops() still finds stored stops',
+              all(stops2.get(stop, {}).get('atco_code') == stop for stop in KNOWN_STOPS))
+        check(results, 'OFFLINE prefetch_stops() returns other stops as {}',
+              all(stops2.get(stop) == {} for stop in new_stops))
+
+        client = util.get_client()
+        try:
+            found = [util.lookup(client, None, stop, {}, {}) for stop in KNOWN_STOPS + new_stops]
+            network = False
+        except (AssertionError, RuntimeError) as e:
+            logger.error('%s', e)
+            found = []
+            network = True
+        check(results, 'OFFLINE lookup() doesn\'t use the network or the API', not network)
+        check(results, 'OFFLINE lookup() finds stored stops and returns others as {}',
+              [stop.get('atco_code') for stop in found] == KNOWN_STOPS + [None] * len(new_stops))
+    finally:
+        requests.Session = requests_session
+        util.OFFLINE = False
+
+
+def main():
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    if len(sys.argv) > 1:
+        logger.error('Usage: %s', sys.argv[0])
+        sys.exit(1)
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        util.STOP_STORE = os.path.join(directory, 'stops.sqlite')
+        util._stop_store = None
+        util._failed_stops.clear()
+
+        session = StubSession()
+        util._session = session
+
+        check_online(results, session)
+        check_offline(results)
+
+    logger.info('%s of %s checks passed', sum(results), len(results))
+
+    if not all(results):
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
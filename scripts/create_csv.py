@@ -12,6 +12,8 @@ import sys
 
 import isodate
 
+from trip import recorded_at
+
 logger = logging.getLogger('__name__')
 
 
@@ -28,6 +30,30 @@ def load_rows(day):
     return merged
 
 
+def resolve_rows(row_data):
+    '''
+    Return the rows from the contents of a rows-<YYYY>-<mm>-<dd>.json
+    file with their journey and trip ids replaced by the journeys and
+    trips they refer to (files written before these were split out
+    into their own lists already have them in place)
+    '''
+
+    if 'journeys' not in row_data:
+        return row_data['rows']
+
+    journeys = row_data['journeys']
+    trips = row_data['trips']
+    rows = []
+    for row in row_data['rows']:
+        row = dict(row)
+        if row['journey'] is not None:
+            row['journey'] = journeys[row['journey']]
+        if row['trip'] is not None:
+            row['trip'] = trips[row['trip']]
+        rows.append(row)
+    return rows
+
+
 def format_minutes(seconds):
     '''
     Format a datetime in minuites and fractions thereof
@@ -72,6 +98,8 @@ def emit_csv(day, rows):
             'Trip_Arrival',
             'Delay_Departure',
             'Delay_Arrival',
+            'Stops_Passed',
+            'Rejected',
         ))
 
         # For each result row
@@ -100,10 +128,10 @@ def emit_csv(day, rows):
             else:
                 departure_position = trip['departure_position']
                 if departure_position is not None:
-                    departure = isodate.parse_datetime(trip['positions'][departure_position]['RecordedAtTime'])
+                    departure = recorded_at(trip, departure_position)
                 arrival_position = trip['arrival_position']
                 if arrival_position is not None:
-                    arrival = isodate.parse_datetime(trip['positions'][arrival_position]['RecordedAtTime'])
+                    arrival = recorded_at(trip, arrival_position)
                 trip_fields = (
                     trip['LineRef'],
                     trip['OperatorRef'],
@@ -113,6 +141,13 @@ def emit_csv(day, rows):
                     arrival.strftime("%H:%M:%S") if arrival else '',
                 )
 
+            # Rows written before trips were scored have neither
+            score = row.get('score')
+            score_fields = (
+                '{passed}/{stops}'.format(**score) if score else '',
+                'Y' if row.get('rejected') else '',
+            )
+
             time = isodate.parse_datetime(row['time'])
 
             r = (
@@ -133,7 +168,8 @@ def emit_csv(day, rows):
                     (
                         format_minutes(row['departure_delay']),
                         format_minutes(row['arrival_delay'])
-                    )
+                    ) +
+                    score_fields
             )
 
             output.writerow(r)
@@ -155,7 +191,7 @@ def main():
 
     row_data = load_rows(day)
 
-    emit_csv(day, row_data['rows'])
+    emit_csv(day, resolve_rows(row_data))
 
     logger.info('Stop')
 
@@ -21,6 +21,7 @@ from merge import do_merge, clasify_matches
 from extract_stops import lookup_stops, emit_stops
 from expand_merged import expand, emit_json
 from create_csv import emit_csv
+from trajectory import score_matches
 
 
 logger = logging.getLogger('__name__')
@@ -70,6 +71,10 @@ def main():
     # Lookup stops referenced in the merged data
     all_stops = lookup_stops(client, schema, merged, interesting_stops)
 
+    # Rank the trips in groups with more than one and reject those that
+    # weren't running the journey
+    score_matches(merged, all_stops)
+
     # Expand merged data into one row per journey/trip match
     rows = expand(day, merged, all_stops)
 
@@ -16,6 +16,9 @@ import sys
 
 import isodate
 
+from trajectory import as_trips, score_matches, stop_delays
+from trip import json_default, recorded_at
+
 logger = logging.getLogger('__name__')
 
 # Unicode characters used to show relationship between journeys and trips
@@ -90,11 +93,21 @@ def describe_stop(stop_code, stops):
     return ', '.join(result)
 
 
-def expand(day, merged, stops):
+def expand(day, merged, stops, converted=None):
     '''
     Expand merged representation of the relationship into an array of
-    rows (in date/time order). Add departure & arrival delay for all
-    journey -> trip matches.
+    rows (in date/time order). Add departure & arrival delay, and the
+    delay at each of the journey's stops (see trajectory.stop_delays()),
+    for all journey -> trip matches.
+
+    Each row's 'score' is its trip's score from
+    trajectory.score_matches(), if it has one. Trips rejected by
+    score_matches() follow their group's rows as '0-1' rows of their
+    own, with 'rejected' set and their score.
+
+    Trip dictionaries are converted to Trips for stop_delays() once per
+    group, or just once given the dictionary 'converted' already used
+    by score_matches() (see trajectory.as_trips()).
     '''
 
     rows = []
@@ -131,7 +144,10 @@ def expand(day, merged, stops):
                     'separator': seperator[row_ctr],
                     'trip': trip,
                     'departure_delay': None,
-                    'arrival_delay': None
+                    'arrival_delay': None,
+                    'stop_delays': None,
+                    'score': None,
+                    'rejected': False
                 }
                 rows.append(row)
                 row_ctr += 1
@@ -150,28 +166,33 @@ def expand(day, merged, stops):
                     'separator': seperator[row_ctr],
                     'trip': None,
                     'departure_delay': None,
-                    'arrival_delay': None
+                    'arrival_delay': None,
+                    'stop_delays': None,
+                    'score': None,
+                    'rejected': False
                 }
                 rows.append(row)
                 row_ctr += 1
         # Everything else
         else:
             row_ctr = 0
+            scores = result.get('scores', [None] * len(trips))
+            converted_trips = as_trips(trips, converted)
             for journey in journeys:
                 first_stop_time = isodate.parse_datetime(journey['stops'][0]['time'])
                 last_stop_time = isodate.parse_datetime(journey['stops'][-1]['time'])
-                for trip in trips:
+                for trip, converted_trip, score in zip(trips, converted_trips, scores):
 
                     departure_position = trip['departure_position']
                     if departure_position is not None:
-                        departure_time = isodate.parse_datetime(trip['positions'][departure_position]['RecordedAtTime'])
+                        departure_time = recorded_at(trip, departure_position)
                         departure_delay = int((departure_time - first_stop_time).total_seconds())
                     else:
                         departure_delay = None
 
                     arrival_position = trip['arrival_position']
                     if arrival_position is not None:
-                        arrival_time = isodate.parse_datetime(trip['positions'][arrival_position]['RecordedAtTime'])
+                        arrival_time = recorded_at(trip, arrival_position)
                         arrival_delay = int((arrival_time - last_stop_time).total_seconds())
                     else:
                         arrival_delay = None
@@ -187,31 +208,91 @@ def expand(day, merged, stops):
                         'separator': seperator[row_ctr],
                         'trip': trip,
                         'departure_delay': departure_delay,
-                        'arrival_delay': arrival_delay
+                        'arrival_delay': arrival_delay,
+                        'stop_delays': stop_delays(journey, converted_trip, stops),
+                        'score': score,
+                        'rejected': False
                     }
                     rows.append(row)
                     row_ctr += 1
 
+        # Trips rejected from the group
+        for trip, score in zip(result.get('rejected', []), result.get('rejected_scores', [])):
+            row = {
+                'type': '0-1',
+                'time': trip['OriginAimedDepartureTime'],
+                'origin': trip['OriginRef'],
+                'origin_desc': describe_stop(trip['OriginRef'], stops),
+                'destination': trip['DestinationRef'],
+                'destination_desc': describe_stop(trip['DestinationRef'], stops),
+                'journey': None,
+                'separator': seps['0-1'][2],
+                'trip': trip,
+                'departure_delay': None,
+                'arrival_delay': None,
+                'stop_delays': None,
+                'score': score,
+                'rejected': True
+            }
+            rows.append(row)
+
     logger.info('Expanded into %s rows', len(rows))
 
     return rows
 
 
+def normalize(rows):
+    '''
+    Return lists of the distinct journeys and trips in rows, and a copy
+    of rows referring to each by its position in the corresponding
+    list (or None) instead of including it
+    '''
+
+    journeys = []
+    trips = []
+    journey_ids = {}
+    trip_ids = {}
+    result = []
+
+    for row in rows:
+        row = dict(row)
+        if row['journey'] is not None:
+            key = id(row['journey'])
+            if key not in journey_ids:
+                journey_ids[key] = len(journeys)
+                journeys.append(row['journey'])
+            row['journey'] = journey_ids[key]
+        if row['trip'] is not None:
+            key = id(row['trip'])
+            if key not in trip_ids:
+                trip_ids[key] = len(trips)
+                trips.append(row['trip'])
+            row['trip'] = trip_ids[key]
+        result.append(row)
+
+    return journeys, trips, result
+
+
 def emit_json(day, bounding_box, rows):
     '''
-    Print row details in json to 'rows-<YYYY>-<mm>-<dd>.json'
+    Print row details in json to 'rows-<YYYY>-<mm>-<dd>.json', with each
+    journey and trip appearing just once (see normalize())
     '''
 
     json_filename = 'rows-{:%Y-%m-%d}.json'.format(day)
     logger.info('Outputing JSON to %s', json_filename)
 
+    journeys, trips, rows = normalize(rows)
+
     with open(json_filename, 'w', newline='') as jsonfile:
         output = {
             'day': day.strftime('%Y-%m-%d'),
             'bounding_box': bounding_box,
+            'journeys': journeys,
+            'trips': trips,
             'rows': rows,
         }
-        json.dump(output, jsonfile, indent=4, sort_keys=True)
+        json.dump(output, jsonfile, indent=4, sort_keys=True, default=json_default)
 
     logger.info('Json output done')
 
@@ -241,7 +322,13 @@ def main():
                      merged_data['bounding_box'], stops_data['bounding_box'])
         sys.exit()
 
-    rows = expand(day, merged_data['merged'], stops_data['stops'])
+    # The trips are read back as dictionaries: convert each of them
+    # just once for both scoring and expansion
+    converted = {}
+
+    score_matches(merged_data['merged'], stops_data['stops'], converted)
+
+    rows = expand(day, merged_data['merged'], stops_data['stops'], converted)
 
     emit_json(day, merged_data['bounding_box'], rows)
 
@@ -13,7 +13,7 @@ import logging
 import sys
 
 from util import (
-    API_SCHEMA, BOUNDING_BOX, get_client, get_stops, lookup
+    API_SCHEMA, BOUNDING_BOX, get_client, get_stops, lookup, prefetch_stops
 )
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
@@ -55,6 +55,8 @@ def lookup_stops(client, schema, matches, interesting_stops):
     logger.info('Found %s stops in merged data', len(stop_ids))
 
     other_stops = {}
+    prefetch_stops(stop_ids, interesting_stops, other_stops)
+
     results = {}
     for stop in stop_ids:
         results[stop] = lookup(client, schema, stop, interesting_stops, other_stops)
@@ -6,15 +6,17 @@ Retrieve trip information
 Given a date, process TNDS timetable files and emit all the
 timetabled journeys that run on that date where at least one of the
 first and last stops in a list of stops defined by a bounding box.
+Given a second date, do the same for every day from the first to
+the second inclusive, parsing each timetable file only once.
 
 Output the resulting data in json.
 '''
 
 import datetime
-import glob
+import functools
 import json
 import logging
-import os
+import multiprocessing
 import sys
 import xml.etree.ElementTree as ET
 
@@ -22,9 +24,10 @@ import isodate
 import pytz
 import txc_helper
 
+from tnds_index import TimetableFile, TimetableIndex, region_sources
 from util import (
-    API_SCHEMA, BOUNDING_BOX, TIMETABLE_PATH, TNDS_REGIONS, get_client,
-    get_stops
+    API_SCHEMA, BOUNDING_BOX, TIMETABLE_INDEX, TIMETABLE_PATH, TIMETABLE_SOURCE,
+    TNDS_REGIONS, TNDS_WORKERS, get_client, get_stops
 )
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
@@ -35,157 +38,353 @@ NS = {'n': 'http://www.transxchange.org.uk/'}
 UK_LOCAL = pytz.timezone('Europe/London')
 
 
-def process(filename, day, interesting_stops):
+def text(element, path):
+    '''
+    Return the text of the first element matching path below element,
+    or None if there isn't one
+    '''
+    child = element.find(path, NS)
+    if child is None:
+        return None
+    return child.text
+
+
+def tag(name):
+    '''
+    Return the fully-qualified form of a TransXChange tag name
+    '''
+    return '{%s}%s' % (NS['n'], name)
+
+
+def load_service(service):
+    '''
+    Compile a <Service> element
+    '''
+    service_end = text(service, 'n:OperatingPeriod/n:EndDate')
+    return {
+        'PrivateCode': text(service, 'n:PrivateCode'),
+        'ServiceCode': text(service, 'n:ServiceCode'),
+        'Description': text(service, 'n:Description'),
+        'LineName': text(service, 'n:Lines/n:Line/n:LineName'),
+        'RegisteredOperatorRef': text(service, 'n:RegisteredOperatorRef'),
+        'StartDate': datetime.datetime.strptime(
+            text(service, 'n:OperatingPeriod/n:StartDate'), '%Y-%m-%d').date(),
+        'EndDate': (datetime.datetime.strptime(service_end, '%Y-%m-%d').date()
+                    if service_end is not None else None),
+        'OperatingProfile': txc_helper.OperatingProfile.from_et(
+            service.find('n:OperatingProfile', NS)),
+    }
+
+
+def load_journey_pattern(journey_pattern):
+    '''
+    Compile a <JourneyPattern> element
+    '''
+    return {
+        'Direction': text(journey_pattern, 'n:Direction'),
+        'JourneyPatternSectionRefs': [
+            element.text for element in
+            journey_pattern.findall('n:JourneyPatternSectionRefs', NS)
+        ],
+    }
+
+
+def load_journey_pattern_section(journey_pattern_section):
+    '''
+    Compile a <JourneyPatternSection> element into a list of links
+    '''
+    links = []
+    for link in journey_pattern_section.findall('n:JourneyPatternTimingLink', NS):
+        From = link.find('n:From', NS)
+        to = link.find('n:To', NS)
+        # Note that WaitTime is looked up without a namespace and
+        # so is never actually found
+        wait_time = to.find('n:WaitTime')
+        links.append({
+            'From': {
+                'StopPointRef': text(From, 'n:StopPointRef'),
+                'Order': From.get('SequenceNumber'),
+                'Activity': text(From, 'n:Activity'),
+                'TimingStatus': text(From, 'n:TimingStatus'),
+            },
+            'To': {
+                'StopPointRef': text(to, 'n:StopPointRef'),
+                'Order': to.get('SequenceNumber'),
+                'Activity': text(to, 'n:Activity'),
+                'TimingStatus': text(to, 'n:TimingStatus'),
+            },
+            'RunTime': text(link, 'n:RunTime'),
+            'WaitTime': wait_time.text if wait_time is not None else None,
+        })
+    return links
+
+
+def load_vehicle_journey(vehicle_journey):
+    '''
+    Compile a <VehicleJourney> element. Its OperatingProfile still
+    needs to be combined with that of its service
+    '''
+    return {
+        'PrivateCode': text(vehicle_journey, 'n:PrivateCode'),
+        'VehicleJourneyCode': text(vehicle_journey, 'n:VehicleJourneyCode'),
+        'ServiceRef': text(vehicle_journey, 'n:ServiceRef'),
+        'JourneyPatternRef': text(vehicle_journey, 'n:JourneyPatternRef'),
+        'DepartureTime': text(vehicle_journey, 'n:DepartureTime'),
+        'OperatingProfile': txc_helper.OperatingProfile.from_et(
+            vehicle_journey.find('n:OperatingProfile', NS)),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def parse_duration(duration):
+    '''
+    Memoized version of isodate.parse_duration() returning seconds
+    '''
+    return isodate.parse_duration(duration).total_seconds()
+
+
+def load_stop_template(journey_pattern, journey_pattern_sections):
+    '''
+    Return a list of (stop, offset) pairs describing the stops visited
+    by a journey pattern, where stop contains everything except the
+    time at the stop and offset is the time in seconds from the
+    journey's departure
+    '''
+
+    template = []
+    offset = 0
+    for journey_pattern_section_id in journey_pattern['JourneyPatternSectionRefs']:
+
+        for link in journey_pattern_sections[journey_pattern_section_id]:
+
+            # Collect details for the 'from' stop
+            stop = dict(link['From'])
+            stop['run_time'] = link['RunTime']
+            stop_offset = offset
+
+            # Work out the time at the next stop
+            offset += parse_duration(link['RunTime'])
+
+            to = link['To']
+            if link['WaitTime'] is not None:
+                stop['wait_time'] = link['WaitTime']
+                offset += parse_duration(link['WaitTime'])
+
+            template.append((stop, stop_offset))
+
+        # Append details for the final stop
+        template.append((dict(to), offset))
+
+    return template
+
+
+def load_timetable(filename, stream=None):
+    '''
+    Compile one TNDS data file
+
+    Parse filename (or stream, a binary file object, if supplied) and
+    return a dictionary
+    containing the services, operators, journey patterns, journey
+    pattern sections and vehicle journeys that it contains, in a
+    form that can be cached in a TimetableIndex.
+
+    The file is parsed in a single streaming pass, compiling each
+    Operator, Service, JourneyPatternSection and VehicleJourney as
+    soon as it is complete and then discarding it
+    '''
+
+    logger.debug('Parsing %s', filename)
+
+    if stream is not None:
+        source = stream
+    else:
+        source = filename
+
+    services = {}
+    operators = {}
+    journey_patterns = {}
+    journey_pattern_sections = {}
+    vehicle_journeys = []
+
+    operator_tag = tag('Operator')
+    service_tag = tag('Service')
+    journey_pattern_section_tag = tag('JourneyPatternSection')
+    vehicle_journey_tag = tag('VehicleJourney')
+
+    depth = 0
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+
+        if event == 'start':
+            depth += 1
+            continue
+
+        # Children of the top-level collections (<Operators>,
+        # <Services>, ...)
+        if depth == 3:
+            if element.tag == operator_tag:
+                operators[element.get('id')] = {
+                    'OperatorCode': text(element, 'n:OperatorCode'),
+                    'OperatorNameOnLicence': text(element, 'n:OperatorNameOnLicence'),
+                }
+            elif element.tag == service_tag:
+                services[text(element, 'n:ServiceCode')] = load_service(element)
+                for journey_pattern in element.findall('n:StandardService/n:JourneyPattern', NS):
+                    journey_patterns[journey_pattern.get('id')] = load_journey_pattern(journey_pattern)
+            elif element.tag == journey_pattern_section_tag:
+                journey_pattern_sections[element.get('id')] = load_journey_pattern_section(element)
+            elif element.tag == vehicle_journey_tag:
+                vehicle_journeys.append(load_vehicle_journey(element))
+            element.clear()
+
+        # The top-level collections themselves
+        elif depth == 2:
+            element.clear()
+
+        depth -= 1
+
+    # Combine the Service and Journey OperatingProfiles now that all
+    # the services are known
+    for vehicle_journey in vehicle_journeys:
+        service = services[vehicle_journey['ServiceRef']]
+        vehicle_journey['OperatingProfile'].defaults_from(service['OperatingProfile'])
+
+    # Work out the stops and relative timings for each journey pattern
+    for journey_pattern in journey_patterns.values():
+        journey_pattern['stops'] = load_stop_template(
+            journey_pattern, journey_pattern_sections)
+
+    # Build the file's manifest: the first and last stops of all its
+    # journeys, and all the stops they visit
+    terminal_stops = set()
+    stops = set()
+    for journey_pattern_id in set(vj['JourneyPatternRef'] for vj in vehicle_journeys):
+        template = journey_patterns[journey_pattern_id]['stops']
+        terminal_stops.add(template[0][0]['StopPointRef'])
+        terminal_stops.add(template[-1][0]['StopPointRef'])
+        stops.update(stop['StopPointRef'] for stop, _ in template)
+
+    return {
+        'services': services,
+        'operators': operators,
+        'journey_patterns': journey_patterns,
+        'journey_pattern_sections': journey_pattern_sections,
+        'vehicle_journeys': vehicle_journeys,
+        'terminal_stops': terminal_stops,
+        'stops': stops,
+    }
+
+
+def process(source, day, interesting_stops, index=None):
     '''
     Process one TNDS data file
 
     Return a list of journeys and the set of stop ATCOCodes that
-    they reference
+    they reference. The compiled file is retrieved from index if
+    supplied.
+    '''
+
+    return process_days(source, [day], interesting_stops, index)[0]
+
+
+def process_days(source, days, interesting_stops, index=None):
+    '''
+    Process one TNDS data file for several days
+
+    'source' is a filename, or a TimetableFile or ZipMember. Return a
+    list containing a list of journeys for each of 'days', parsing the
+    file (or retrieving it from index) only once
     '''
 
-    logger.debug('Processing %s', filename)
+    if isinstance(source, str):
+        source = TimetableFile(source)
+
+    logger.debug('Processing %s', source.name)
+
+    if index is None:
+        with source.open() as stream:
+            timetable = load_timetable(source.name, stream)
+    else:
+        # Skip files that can't contain a journey that starts or ends
+        # at an interesting stop
+        manifest = index.manifest(source)
+        if manifest is not None and manifest[0].isdisjoint(interesting_stops):
+            index.skips += 1
+            return [[] for day in days]
+        timetable = index.load(source, load_timetable)
+
+    # Work out the days on which each journey runs within its service's
+    # operating period
+    for vehicle_journey in timetable['vehicle_journeys']:
+        service = timetable['services'][vehicle_journey['ServiceRef']]
+        vehicle_journey['days'] = vehicle_journey['OperatingProfile'].compile(
+            service['StartDate'], service['EndDate'])
+
+    return [journeys_for_day(source.name, timetable, day, interesting_stops)
+            for day in days]
 
-    service_cache = {}
 
-    tree = ET.parse(filename).getroot()
+def journeys_for_day(filename, timetable, day, interesting_stops):
+    '''
+    Return a list of the journeys in a compiled TNDS file (as prepared
+    by process_days()) that run on 'day' and that start or end at one
+    of interesting_stops
+    '''
 
     journeys = []
 
     # Process each VehicleJourney in the file
-    for vehicle_journey in tree.findall('n:VehicleJourneys/n:VehicleJourney', NS):
-
-        # Find and process the journey's 'parent' service
-        #
-        # This is probably inefficient, since TNDS data files seem only
-        # ever to contain one service, but at least this avoids having to
-        # make that assumption. To address this, cache services as they
-        # are found
-
-        service_ref = vehicle_journey.find('n:ServiceRef', NS).text
-        if service_ref in service_cache:
-            service = service_cache[service_ref]
-        else:
-            service = tree.find("n:Services/n:Service[n:ServiceCode='%s']" % service_ref, NS)
-            service_cache[service_ref] = service
+    for vehicle_journey in timetable['vehicle_journeys']:
 
-        # Check the service start/end dates; bail out if out of range
-        service_start = service.find('n:OperatingPeriod/n:StartDate', NS)
-        service_start_date = datetime.datetime.strptime(service_start.text, '%Y-%m-%d').date()
-        if day < service_start_date:
+        # Check the service start/end dates and the combined Service and
+        # Journey OperatingProfile; bail out if this isn't valid on 'date'
+        if day not in vehicle_journey['days']:
             continue
 
-        service_end = service.find('n:OperatingPeriod/n:EndDate', NS)
-        if service_end is not None:
-            service_end_date = datetime.datetime.strptime(service_end.text, '%Y-%m-%d').date()
-            if day > service_end_date:
-                continue
+        service = timetable['services'][vehicle_journey['ServiceRef']]
 
-        # Process the Service and Journey OperatingProfile; bail out
-        # if this isn't dalid on 'date'
-        service_op_element = service.find('n:OperatingProfile', NS)
-        service_op = txc_helper.OperatingProfile.from_et(service_op_element)
+        operator = timetable['operators'][service['RegisteredOperatorRef']]
 
-        journey_op_element = vehicle_journey.find('n:OperatingProfile', NS)
-        journey_op = txc_helper.OperatingProfile.from_et(journey_op_element)
-        journey_op.defaults_from(service_op)
+        # Find corresponding JourneyPattern and drop this journey if
+        # neither its start stop nor its end stop is in the list of
+        # 'interesting' stops (i.e. in the bounding box)
+        journey_pattern_id = vehicle_journey['JourneyPatternRef']
+        journey_pattern = timetable['journey_patterns'][journey_pattern_id]
+        template = journey_pattern['stops']
 
-        if not journey_op.should_show(day):
+        if (template[0][0]['StopPointRef'] not in interesting_stops and
+           template[-1][0]['StopPointRef'] not in interesting_stops):
             continue
 
-        # Extract Operator
-        #
-        # As with Service, this is probably inefficient since TNDS files
-        # only ever seem to contain one Operator, but whatever
-        operator_id = service.find('n:RegisteredOperatorRef', NS).text
-        operator = tree.find('n:Operators/n:Operator[@id="%s"]' % operator_id, NS)
-
         # Extract departure time in various formats
-        departure_time = vehicle_journey.find('n:DepartureTime', NS).text
+        departure_time = vehicle_journey['DepartureTime']
         departure_time_time = datetime.datetime.strptime(departure_time, '%H:%M:%S').time()
         departure_timestamp = UK_LOCAL.localize(datetime.datetime.combine(day, departure_time_time))
 
-        # Find corresponding JourneyPattern...
-        journey_pattern_id = vehicle_journey.find('n:JourneyPatternRef', NS).text
-        journey_pattern = tree.find(
-            'n:Services/n:Service/n:StandardService/n:JourneyPattern[@id="%s"]' % journey_pattern_id, NS)
-
-        # ...and loop over the included JourneyPatternSections
-        #
-        # As with Service and Operator, this is probably inefficient since
-        # TNDS files only ever seem to contain a single JourneyPatternSection
-        # in each JourneyPattern
-        journey_pattern_section_ids = []
+        # Timestamp the stops in the journey pattern
         journey_stops = []
-        time = departure_timestamp
-        for journey_pattern_section_id_element in journey_pattern.findall('n:JourneyPatternSectionRefs', NS):
-
-            journey_pattern_section_id = journey_pattern_section_id_element.text
-            journey_pattern_section_ids.append(journey_pattern_section_id)
-            journey_pattern_section = tree.find(
-                'n:JourneyPatternSections/n:JourneyPatternSection[@id="%s"]' % journey_pattern_section_id, NS)
-
-            for link in journey_pattern_section.findall('n:JourneyPatternTimingLink', NS):
-
-                # Collect details for the 'from' stop
-                From = link.find('n:From', NS)
-                stop = {
-                    'StopPointRef': From.find('n:StopPointRef', NS).text,
-                    'Order': From.get('SequenceNumber'),
-                    'Activity': From.find('n:Activity', NS).text,
-                    'TimingStatus': From.find('n:TimingStatus', NS).text,
-                    'time': time.replace(microsecond=0).isoformat()
-                }
-
-                # Work out the time at the next stop
-                run_time = link.find('n:RunTime', NS).text
-                stop['run_time'] = run_time
-                run_time_duration = isodate.parse_duration(run_time)
-                time += run_time_duration
-
-                to = link.find('n:To', NS)
-                wait_time = to.find('n:WaitTime')
-                if wait_time is not None:
-                    stop['wait_time'] = wait_time.text
-                    wait_time_duration = isodate.parse_duration(wait_time.text)
-                    time += wait_time_duration
-
-                journey_stops.append(stop)
-
-            # Append details for the final stop
-            stop = {
-                'StopPointRef': to.find('n:StopPointRef', NS).text,
-                'Order': to.get('SequenceNumber'),
-                'Activity': to.find('n:Activity', NS).text,
-                'TimingStatus': to.find('n:TimingStatus', NS).text,
-                'time': time.replace(microsecond=0).isoformat()
-            }
-
+        for template_stop, offset in template:
+            stop = dict(template_stop)
+            time = departure_timestamp + datetime.timedelta(seconds=offset)
+            stop['time'] = time.replace(microsecond=0).isoformat()
             journey_stops.append(stop)
 
-        # Drop this journey if neither its start stop nor its end
-        # stop is in the list of 'interesting' stops (i.e. in the bounding
-        # box)
-        if (journey_stops[0]['StopPointRef'] not in interesting_stops and
-           journey_stops[-1]['StopPointRef'] not in interesting_stops):
-            continue
-
         # Populate the result
         journey = {
             'file': filename,
-            'PrivateCode': vehicle_journey.find('n:PrivateCode', NS).text,
-            'VehicleJourneyCode': vehicle_journey.find('n:VehicleJourneyCode', NS).text,
+            'PrivateCode': vehicle_journey['PrivateCode'],
+            'VehicleJourneyCode': vehicle_journey['VehicleJourneyCode'],
             'DepartureTime': departure_timestamp.replace(microsecond=0).isoformat(),
             'Service': {
-                'PrivateCode': service.find('n:PrivateCode', NS).text,
-                'ServiceCode': service.find('n:ServiceCode', NS).text,
-                'Description': service.find('n:Description', NS).text,
-                'LineName': service.find('n:Lines/n:Line/n:LineName', NS).text,
-                'OperatorCode': operator.find('n:OperatorCode', NS).text,
-                'OperatorName': operator.find('n:OperatorNameOnLicence', NS).text,
+                'PrivateCode': service['PrivateCode'],
+                'ServiceCode': service['ServiceCode'],
+                'Description': service['Description'],
+                'LineName': service['LineName'],
+                'OperatorCode': operator['OperatorCode'],
+                'OperatorName': operator['OperatorNameOnLicence'],
             },
             'JourneyPatternId': journey_pattern_id,
-            'Direction': journey_pattern.find('n:Direction', NS).text,
-            'JourneyPatternSectionIds': journey_pattern_section_ids,
+            'Direction': journey_pattern['Direction'],
+            'JourneyPatternSectionIds': list(journey_pattern['JourneyPatternSectionRefs']),
             'stops': journey_stops,
         }
         journeys.append(journey)
@@ -195,7 +394,34 @@ def process(filename, day, interesting_stops):
     return journeys
 
 
-def get_journeys(day, interesting_stops, regions):
+# Per-process state for get_journeys' worker pool
+_worker = {}
+
+
+def _init_worker(days, interesting_stops):
+    '''
+    Set up a get_journeys worker process with its own index connection
+    '''
+    _worker['days'] = days
+    _worker['interesting_stops'] = interesting_stops
+    _worker['index'] = TimetableIndex(TIMETABLE_INDEX) if TIMETABLE_INDEX else None
+
+
+def _process_worker(source):
+    '''
+    Run process_days() in a worker, returning the journeys and flags
+    indicating if the file had to be parsed or was skipped
+    '''
+    index = _worker['index']
+    if index is None:
+        journeys = process_days(source, _worker['days'], _worker['interesting_stops'])
+        return journeys, True, False
+    misses, skips = index.misses, index.skips
+    journeys = process_days(source, _worker['days'], _worker['interesting_stops'], index)
+    return journeys, index.misses > misses, index.skips > skips
+
+
+def get_journeys(day, interesting_stops, regions, workers=TNDS_WORKERS):
     '''
     Retrieve timetable journeys
 
@@ -207,29 +433,120 @@ def get_journeys(day, interesting_stops, regions):
     they reference
     '''
 
-    journey_list = []
+    return get_journeys_range(day, day, interesting_stops, regions, workers)[day]
+
+
+def get_journeys_range(start, end, interesting_stops, regions, workers=TNDS_WORKERS):
+    '''
+    Retrieve timetable journeys for a range of days
+
+    As get_journeys(), but for every day from 'start' to 'end'
+    inclusive while only processing each timetable file once. Files
+    are processed in filename order, in a pool of 'workers' processes
+    if 'workers' is greater than 1.
+
+    Return a dictionary of lists of journeys, keyed by day
+    '''
+
+    days = [start + datetime.timedelta(days=n) for n in range((end - start).days + 1)]
+    journey_lists = {day: [] for day in days}
+
+    # Opened before any workers are started so that they find the
+    # index in its current format
+    index = TimetableIndex(TIMETABLE_INDEX) if TIMETABLE_INDEX else None
+
+    pool = None
+    if workers > 1:
+        logger.info('Starting %s workers', workers)
+        pool = multiprocessing.Pool(
+            workers, initializer=_init_worker, initargs=(days, interesting_stops))
+    else:
+        _init_worker(days, interesting_stops)
+        _worker['index'] = index
+
+    file_counter = parsed_counter = skipped_counter = 0
 
     try:
         for region in regions:
 
-            path = os.path.join(TIMETABLE_PATH, region, '*.xml')
-            logger.info('Processing from %s', path)
-            journey_counter = stop_counter = 0
+            location, sources = region_sources(
+                TIMETABLE_PATH, region, TIMETABLE_SOURCE == 'zip')
+            logger.info('Processing from %s', location)
+            journey_counter = 0
+
+            if pool is None:
+                results = map(_process_worker, sources)
+            else:
+                results = pool.imap(_process_worker, sources, chunksize=8)
 
-            for filename in glob.iglob(path):
-                journeys = process(filename, day, interesting_stops)
-                journey_list.extend(journeys)
-                journey_counter += len(journeys)
+            for journeys_by_day, parsed, skipped in results:
+                for day, journeys in zip(days, journeys_by_day):
+                    journey_lists[day].extend(journeys)
+                    journey_counter += len(journeys)
+                file_counter += 1
+                parsed_counter += parsed
+                skipped_counter += skipped
 
             logger.info(
                 'Got %s journeys', journey_counter)
 
+            if index is not None:
+                index.prune(location, set(source.name for source in sources))
+
     except KeyboardInterrupt:
-        pass
+        if pool is not None:
+            pool.terminate()
 
-    logger.info('Got total of %s journeys', len(journey_list))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _worker.clear()
+        if index is not None:
+            index.close()
 
-    return journey_list
+    logger.info('Processed %s files, of which %s needed parsing and %s were skipped',
+                file_counter, parsed_counter, skipped_counter)
+    for day in days:
+        logger.info('Got total of %s journeys for %s', len(journey_lists[day]), day)
+
+    return journey_lists
+
+
+def build_index(filename, regions):
+    '''
+    Bring the timetable index in 'filename' (and so the file manifests
+    it contains) up to date for all the TNDS files in 'regions'
+
+    Return sets of the codes of the services that have been added,
+    removed or modified
+    '''
+
+    index = TimetableIndex(filename)
+
+    added = set()
+    removed = set()
+    modified = set()
+
+    try:
+        for region in regions:
+            location, sources = region_sources(
+                TIMETABLE_PATH, region, TIMETABLE_SOURCE == 'zip')
+            logger.info('Indexing %s files in %s', len(sources), location)
+            region_added, region_removed, region_modified = index.refresh(
+                location, sources, load_timetable)
+            added |= region_added
+            removed |= region_removed
+            modified |= region_modified
+    finally:
+        index.close()
+
+    logger.info('Timetable index: %s files unchanged, %s parsed',
+                index.hits, index.misses)
+    logger.info('Services: %s added, %s removed, %s modified',
+                len(added), len(removed), len(modified))
+
+    return added, removed, modified
 
 
 def emit_journeys(day, journeys):
@@ -256,7 +573,11 @@ def main():
     logger.info('Start')
 
     try:
-        day = datetime.datetime.strptime(sys.argv[1], '%Y-%m-%d').date()
+        start = datetime.datetime.strptime(sys.argv[1], '%Y-%m-%d').date()
+        if len(sys.argv) > 2:
+            end = datetime.datetime.strptime(sys.argv[2], '%Y-%m-%d').date()
+        else:
+            end = start
     except ValueError:
         logger.error('Failed to parse date')
         sys.exit()
@@ -268,10 +589,11 @@ def main():
     # Get the list of all the stops we are interested in
     interesting_stops = get_stops(client, schema, BOUNDING_BOX)
 
-    # Retrieve timetable journeys
-    journeys = get_journeys(day, interesting_stops, TNDS_REGIONS)
+    # Retrieve timetable journeys for every day from start to end
+    journey_lists = get_journeys_range(start, end, interesting_stops, TNDS_REGIONS)
 
-    emit_journeys(day, journeys)
+    for day, journeys in journey_lists.items():
+        emit_journeys(day, journeys)
 
     logger.info('Stop')
 
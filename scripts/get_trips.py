@@ -44,194 +44,383 @@ Input file format:
 '''
 
 import datetime
-import glob
 import json
 import logging
-import os
+import multiprocessing
 import sys
 
-from haversine import haversine
+from haversine import haversine_vector
 import isodate
+import numpy
 
+from sirivm import FileIndex, day_files, interesting_records
+from sirivm_archive import POSITION_COLUMNS, archive_filename, read_archive
+from spatial import stop_position
+from trip import NO_DELAY, TRIP_FIELDS, UK_LOCAL, Trip, json_default
 from util import (
-    API_SCHEMA, BOUNDING_BOX, LOAD_PATH, get_client, get_stops,
-    update_bbox, lookup
+    API_SCHEMA, BOUNDING_BOX, LOAD_PATH, SIRIVM_ARCHIVE_PATH,
+    SIRIVM_WORKERS, get_client, get_stops, lookup, prefetch_stops
 )
 
 logger = logging.getLogger('__name__')
 
 other_stops = {}
 
+# The fields that identify a trip
+KEY_FIELDS = (
+    'OriginRef', 'DestinationRef', 'OriginAimedDepartureTime', 'LineRef',
+    'OperatorRef', 'DirectionRef', 'VehicleRef'
+)
+
 
-def get_trips(client, schema, date, interesting_stops):
+def add_records(trips, records):
+    '''
+    Add position records to a dictionary of partial trips (unfinished
+    Trips) keyed by OriginRef, DestinationRef, OriginAimedDepartureTime,
+    LineRef, OperatorRef, DirectionRef and VehicleRef. Return the set
+    of keys of the trips that were added to
     '''
-    Extract trips for a day
 
-    Return a list of all trips (realtime journeys) on the day
-    indicated by year/month/day that have origin or destination stops in
-    our stops list (and so fall within our bounding box)
+    keys = set()
+
+    for record in records:
+
+        # Form a unique key for this data
+        key = tuple(record[field] for field in KEY_FIELDS)
+
+        # Collect all the data that's common for one trip
+        if key not in trips:
+            trips[key] = Trip(record)
+
+        trips[key].add(record)
+        keys.add(key)
+
+    return keys
+
+
+def collect_trips(filenames, interesting_stops):
+    '''
+    Return a dictionary of partial trips (see add_records()) from the
+    interesting records in filenames
     '''
 
     trips = {}
 
-    path = os.path.join(
-        LOAD_PATH, date.strftime('%Y'), date.strftime('%m'),
-        date.strftime('%d'), '*.json')
-    logger.info('Processing from %s', path)
-
-    for filename in glob.iglob(path):
+    for filename in filenames:
 
         logger.debug("Processing %s", filename)
 
-        with open(filename) as data_file:
-            data = json.load(data_file)
-
-        for record in data["request_data"]:
-
-            # Skip if neither origin nor destination in our list of stops
-            if (record['OriginRef'] not in interesting_stops and
-               record['DestinationRef'] not in interesting_stops):
-                continue
-
-            # Form a unique key for this data
-            key = (
-                record['OriginRef'],
-                record['DestinationRef'],
-                record['OriginAimedDepartureTime'],
-                record['LineRef'],
-                record['OperatorRef'],
-                record['DirectionRef'],
-                record['VehicleRef'],
-            )
-
-            # Collect all the data that's common for one trip
-            TRIP_FIELDS = (
-                'DestinationName', 'DestinationRef', 'DirectionRef', 'LineRef',
-                'OperatorRef', 'OriginAimedDepartureTime', 'OriginName',
-                'OriginRef', 'VehicleRef'
-            )
+        # Records are read one at a time, skipping those where neither
+        # origin nor destination is in our list of stops
+        add_records(trips, interesting_records(filename, interesting_stops))
+
+    return trips
+
+
+def merge_trips(partials):
+    '''
+    Merge a list of dictionaries of partial trips, each collected from
+    successive files, into one
+    '''
+
+    trips = {}
 
+    for partial in partials:
+        for key, trip in partial.items():
             if key not in trips:
+                trips[key] = trip
+            else:
+                trips[key].extend(trip)
 
-                trips[key] = {field: record[field] for field in TRIP_FIELDS}
+    return trips
 
-                trips[key]['OriginStop'] = lookup(
-                    client, schema,
-                    record['OriginRef'],
-                    interesting_stops,
-                    other_stops)
-                trips[key]['DestinationStop'] = lookup(
-                    client, schema,
-                    record['DestinationRef'],
-                    interesting_stops,
-                    other_stops)
 
-                trips[key]['positions'] = []
+def archived_trips(archive, interesting_stops):
+    '''
+    Return a dictionary of partial trips (see add_records()) from the
+    interesting records in a day's SIRI-VM archive, as returned by
+    sirivm_archive.read_archive()
+    '''
 
-                trips[key]['bbox'] = [None, None, None, None]
+    # Records where at least one of the origin or destination is in
+    # our list of stops
+    selected = numpy.zeros(len(archive['timestamp']), dtype=bool)
+    for field in ('OriginRef', 'DestinationRef'):
+        interesting = numpy.array(
+            [value in interesting_stops for value in archive[field + '_values'].tolist()],
+            dtype=bool)
+        if len(interesting):
+            selected |= interesting[archive[field]]
+    rows = numpy.flatnonzero(selected)
+
+    if len(rows) == 0:
+        return {}
+
+    # Group the records by trip, keeping them in file order within each
+    # trip and the trips in order of their first record
+    keys = numpy.column_stack([archive[field][rows] for field in KEY_FIELDS])
+    _, first, group = numpy.unique(keys, axis=0, return_index=True, return_inverse=True)
+    group = group.ravel()
+    order = numpy.argsort(group, kind='stable')
+    ends = numpy.cumsum(numpy.bincount(group))
+    starts = ends - numpy.bincount(group)
+
+    # Drop positions that repeat the one before them in the same trip
+    # (as Trip.add() does)
+    ordered = rows[order]
+    repeat = numpy.zeros(len(ordered), dtype=bool)
+    repeat[1:] = ((group[order][1:] == group[order][:-1]) &
+                  (archive['timestamp'][ordered][1:] == archive['timestamp'][ordered][:-1]) &
+                  (archive['latitude'][ordered][1:] == archive['latitude'][ordered][:-1]) &
+                  (archive['longitude'][ordered][1:] == archive['longitude'][ordered][:-1]))
 
-            # ... and the data that makes up a position report
-            POSITION_FIELDS = (
-                'Bearing', 'Delay', 'Latitude', 'Longitude', 'RecordedAtTime'
-            )
+    trips = {}
+    for n in numpy.argsort(first).tolist():
+        members = ordered[starts[n]:ends[n]][~repeat[starts[n]:ends[n]]]
+        fields = {
+            field: str(archive[field + '_values'][archive[field][members[0]]])
+            for field in TRIP_FIELDS
+        }
+        key = tuple(fields[field] for field in KEY_FIELDS)
+        trips[key] = Trip.from_columns(
+            fields, *(archive[name][members] for name, _ in POSITION_COLUMNS),
+            duplicates=int(numpy.count_nonzero(repeat[starts[n]:ends[n]])))
 
-            position = {field: record[field] for field in POSITION_FIELDS}
-            trips[key]['positions'].append(position)
+    return trips
 
-            update_bbox(trips[key]['bbox'],
-                        record['Longitude'],
-                        record['Latitude'])
 
-    logger.info("Found %s trips", len(trips))
+# Per-process state for get_trips' worker pool
+_worker = {}
 
-    # Collect only trips that actually start today (at least some will have
-    # started yesterday), and sort their position records by time
-    result = []
-    skipped_trips = 0
-    for trip in trips.values():
-        departure_timestamp = isodate.parse_datetime(trip['OriginAimedDepartureTime'])
-        if date == departure_timestamp.date():
-            trip['positions'].sort(key=lambda pos: pos['RecordedAtTime'])
-            result.append(trip)
-        else:
-            skipped_trips += 1
 
-    logger.info("Skipped %s trips which started in the wrong day", skipped_trips)
-    logger.info("Found %s interesting trips", len(result))
+def _init_worker(interesting_stops):
+    _worker['interesting_stops'] = interesting_stops
 
-    return result
 
+def _collect_worker(filenames):
+    return collect_trips(filenames, _worker['interesting_stops'])
 
-def derive_timings(trips):
+
+def read_trips(filenames, interesting_stops, workers=SIRIVM_WORKERS):
     '''
-    Workout actual departure and arrival timings for each trip
+    Return a dictionary of partial trips (see add_records()) from the
+    interesting records in 'filenames'. If 'workers' is greater than
+    1, files are read by a pool of that many processes.
     '''
 
-    logger.info('Deriving timings for %s trips', len(trips))
+    logger.info('Processing %s files from %s', len(filenames), LOAD_PATH)
 
-    threshold = 50
+    if workers > 1:
+        # Give each worker several runs of consecutive files and merge
+        # the results in file order
+        n_chunks = min(len(filenames), workers * 4) or 1
+        chunks = [filenames[len(filenames) * n // n_chunks:len(filenames) * (n + 1) // n_chunks]
+                  for n in range(n_chunks)]
+        logger.info('Starting %s workers', workers)
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                  initargs=(interesting_stops, )) as pool:
+            return merge_trips(pool.map(_collect_worker, chunks))
+
+    return collect_trips(filenames, interesting_stops)
+
+
+def day_window(date):
+    '''
+    Return the start and end of 'date' in UK local time
+    '''
+    return (UK_LOCAL.localize(datetime.datetime.combine(date, datetime.time())),
+            UK_LOCAL.localize(datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time())))
 
-    for trip in trips:
 
-        logger.debug('')
-        logger.debug('Processing %s to %s at %s', trip['OriginRef'],
-                     trip['DestinationRef'], trip['OriginAimedDepartureTime'])
+def get_trips(client, schema, date, interesting_stops, workers=SIRIVM_WORKERS):
+    '''
+    Extract trips for a day
 
-        origin = (float(trip['OriginStop']['latitude']),
-                  float(trip['OriginStop']['longitude']))
-        destination = (float(trip['DestinationStop']['latitude']),
-                       float(trip['DestinationStop']['longitude']))
+    Return a list of all trips (realtime journeys) on the day
+    indicated by year/month/day that have origin or destination stops in
+    our stops list (and so fall within our bounding box).
 
-        departure_state = 'before'
-        arrival_state = 'before'
-        departure_position = arrival_position = None
+    The day's SIRI-VM archive is used if there is an up to date one
+    (see sirivm_archive.py). Otherwise, if 'workers' is greater than 1,
+    files are read by a pool of that many processes.
+    '''
+
+    filenames = day_files(LOAD_PATH, date)
+
+    # Use the archive if it was built from the files that are there now,
+    # or if they have gone
+    archive = None
+    if SIRIVM_ARCHIVE_PATH:
+        filename = archive_filename(SIRIVM_ARCHIVE_PATH, date)
+        archive = read_archive(filename, filenames or None)
 
-        for row, position in enumerate(trip['positions']):
+    if archive is not None:
+        logger.info('Processing from %s', filename)
+        trips = archived_trips(archive, interesting_stops)
+    else:
+        trips = read_trips(filenames, interesting_stops, workers)
+
+    logger.info("Found %s trips", len(trips))
 
-            logger.debug('')
-            logger.debug('Processing position %s', row)
-            logger.debug('initial origin state %s; destination state %s', departure_state, arrival_state)
+    start, end = day_window(date)
+    return finish_trips(client, schema, start, end, trips, interesting_stops)
 
-            here = (float(position['Latitude']), float(position['Longitude']))
 
-            origin_distance = haversine(here, origin) * 1000  # in meters
+def get_window_trips(client, schema, start, end, interesting_stops,
+                     overrun=datetime.timedelta(0), workers=SIRIVM_WORKERS):
+    '''
+    Extract trips for an arbitrary period
+
+    Return a list of all trips with origin or destination stops in our
+    stops list that were due to depart from 'start' up to but not
+    including 'end' (both aware datetimes). Only the SIRI-VM files from
+    'start' up to 'end' + 'overrun' are read, from however many days'
+    directories they are in, so a window can be as short as an hour,
+    and a suitable 'overrun' picks up the rest of trips that are still
+    running at 'end' (including any that run past midnight).
+    '''
 
-            logger.debug('Origin distance %s', origin_distance)
+    filenames = FileIndex(LOAD_PATH).files(start, end + overrun)
 
-            if departure_state == 'before' and origin_distance < threshold:
-                departure_state = 'at'
-                logger.debug('Departure state transition before --> at')
-            elif departure_state == 'at' and origin_distance > threshold:
-                departure_position = row - 1
-                departure_state = 'after'
-                logger.debug('Departure state transition at --> after')
+    trips = read_trips(filenames, interesting_stops, workers)
 
-            destination_distance = haversine(here, destination) * 1000  # in meters
+    logger.info("Found %s trips", len(trips))
 
-            logger.debug('Destination distance %s', destination_distance)
+    return finish_trips(client, schema, start, end, trips, interesting_stops)
 
-            if arrival_state == 'before' and destination_distance < threshold:
-                arrival_state = 'at'
-                arrival_position = row
-                logger.debug('Arrival state transition before --> at')
 
-            logger.debug('Final origin state %s; destination state %s', departure_state, arrival_state)
+def finish_trips(client, schema, start, end, trips, interesting_stops):
+    '''
+    Turn a dictionary of trips from collect_trips() into a list of
+    the trips due to depart from 'start' up to but not including 'end',
+    complete with details of their origin and destination stops
+    '''
 
-        # Try a bit harder if we still don't have an arrival_position - use
-        # the very last position if it's within threshold * 4
-        if arrival_position is None:
-            final_position = trip['positions'][-1]
-            final = (float(final_position['Latitude']), float(final_position['Longitude']))
-            if (haversine(final, destination) * 1000) < (threshold * 4):
-                arrival_position = len(trip['positions']) - 1
-                logger.debug('Using final position for arrival')
+    # Collect only trips that actually start in the period (at least some
+    # will have started before it)
+    in_period = []
+    skipped_trips = 0
+    for trip in trips.values():
+        departure_timestamp = isodate.parse_datetime(trip['OriginAimedDepartureTime'])
+        if start <= departure_timestamp < end:
+            in_period.append(trip)
+        else:
+            skipped_trips += 1
 
+    # Look up all their stops at once...
+    prefetch_stops(
+        [trip['OriginRef'] for trip in in_period] + [trip['DestinationRef'] for trip in in_period],
+        interesting_stops, other_stops)
 
-        logger.debug('Departure row %s; arrival row %s', departure_position, arrival_position)
-        logger.debug('')
+    # ... and sort their position records by time
+    result = []
+    for trip in in_period:
+        trip['OriginStop'] = lookup(
+            client, schema,
+            trip['OriginRef'],
+            interesting_stops,
+            other_stops)
+        trip['DestinationStop'] = lookup(
+            client, schema,
+            trip['DestinationRef'],
+            interesting_stops,
+            other_stops)
+        trip.finish()
+        result.append(trip)
+
+    logger.info("Dropped %s duplicate position reports",
+                sum(trip.duplicates for trip in trips.values()))
+    logger.info("Found %s position reports with an invalid Delay",
+                sum(int(numpy.count_nonzero(trip.delay == NO_DELAY)) for trip in result))
+    logger.info("Skipped %s trips which started outside the period", skipped_trips)
+    logger.info("Found %s interesting trips", len(result))
+
+    return result
+
+
+def first_index(indices, starts, ends):
+    '''
+    For each range starts[n]:ends[n] return the first of the sorted
+    array 'indices' that falls in it, or -1 if none do
+    '''
+
+    if len(indices) == 0:
+        return numpy.full(len(starts), -1)
+
+    found = numpy.searchsorted(indices, starts)
+    candidate = indices[numpy.minimum(found, len(indices) - 1)]
+    return numpy.where((found < len(indices)) & (candidate < ends), candidate, -1)
+
+
+def derive_timings(trips):
+    '''
+    Workout actual departure and arrival timings for each trip
+
+    The departure position is the one before the first that is more
+    than 50m from the origin stop after having been within 50m of it.
+    The arrival position is the first within 50m of the destination
+    stop or, failing that, the last position if that's within 200m.
+
+    Distances are calculated for the positions of all the trips at
+    once, and the positions are found with array operations on the
+    result (see benchmark_timings.py for the original, position by
+    position, implementation).
+    '''
+
+    logger.info('Deriving timings for %s trips', len(trips))
+
+    threshold = 50
 
-        trip['departure_position'] = departure_position
-        trip['arrival_position'] = arrival_position
+    if not trips:
+        return
+
+    # Positions of all the trips end to end, trip n occupying
+    # starts[n]:ends[n], with their trip's origin and destination
+    lengths = numpy.array([len(trip) for trip in trips], dtype=numpy.int64)
+    ends = numpy.cumsum(lengths)
+    starts = ends - lengths
+
+    here = numpy.column_stack((
+        numpy.concatenate([trip.latitude for trip in trips]),
+        numpy.concatenate([trip.longitude for trip in trips])))
+    # Stops that couldn't be looked up are nowhere, so are never near
+    nowhere = (float('nan'), float('nan'))
+    origins = numpy.repeat(
+        [stop_position(trip['OriginStop']) or nowhere for trip in trips], lengths, axis=0)
+    destinations = numpy.repeat(
+        [stop_position(trip['DestinationStop']) or nowhere for trip in trips], lengths, axis=0)
+
+    origin_distance = haversine_vector(here, origins) * 1000  # in meters
+    destination_distance = haversine_vector(here, destinations) * 1000  # in meters
+
+    # Departure: 'before' --> 'at' at the first position within threshold
+    # of the origin, 'at' --> 'after' at the next one beyond it
+    at_origin = first_index(numpy.flatnonzero(origin_distance < threshold), starts, ends)
+    after_origin = first_index(
+        numpy.flatnonzero(origin_distance > threshold),
+        numpy.where(at_origin >= 0, at_origin + 1, ends), ends)
+    departure = numpy.where(after_origin >= 0, after_origin - 1, -1)
+
+    # Arrival: 'before' --> 'at' at the first position within threshold
+    # of the destination...
+    arrival = first_index(numpy.flatnonzero(destination_distance < threshold), starts, ends)
+
+    # ... or try a bit harder and use the very last position if it's
+    # within threshold * 4
+    final = numpy.maximum(ends - 1, 0)
+    use_final = (arrival < 0) & (lengths > 0) & (destination_distance[final] < threshold * 4)
+    arrival = numpy.where(use_final, final, arrival)
+
+    for trip, start, departure_row, arrival_row in zip(
+            trips, starts.tolist(), departure.tolist(), arrival.tolist()):
+
+        trip['departure_position'] = departure_row - start if departure_row >= 0 else None
+        trip['arrival_position'] = arrival_row - start if arrival_row >= 0 else None
+
+        logger.debug('%s to %s at %s: departure row %s; arrival row %s',
+                     trip['OriginRef'], trip['DestinationRef'],
+                     trip['OriginAimedDepartureTime'],
+                     trip['departure_position'], trip['arrival_position'])
 
 
 def emit_trips(day, trips):
@@ -248,7 +437,7 @@ def emit_trips(day, trips):
             'bounding_box': BOUNDING_BOX,
             'trips': trips
         }
-        json.dump(output, jsonfile, indent=4, sort_keys=True)
+        json.dump(output, jsonfile, indent=4, sort_keys=True, default=json_default)
 
         logger.info('Output done')
 
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+'''
+Match trips to journeys as the day goes along
+
+Rather than waiting for a whole day's SIRI-VM data, watch the current
+day's directory in SIRIVM_PATH and feed each new file into a LiveTrips
+as it appears. Trips that haven't been seen for IDLE_TIMEOUT are taken
+to be complete: their stops are looked up and their departure and
+arrival positions derived, just as get_trips and derive_timings would.
+Every EMIT_INTERVAL, the trips completed so far together with
+provisional versions of those still running are matched to the day's
+journeys and written out as merged-, stops- and rows-<yyyy>-<mm>-<dd>
+.json and rows-<yyyy>-<mm>-<dd>.csv, exactly as do_everything.py does.
+Once the day is over, processing moves on to the next day. Trips still
+running at midnight carry on collecting positions from the next day's
+files, and the day's final results are written out once they have all
+completed.
+
+A trip that reports again after going quiet for IDLE_TIMEOUT has its
+new positions added to the completed trip and its timings derived
+again, so it appears once in the results, as it would from get_trips.
+
+    live.py [YYYY-MM-DD]
+
+Given a date in the past, its files, and those of the following days,
+are processed straight away before continuing with today's.
+'''
+
+import bisect
+import collections
+import datetime
+import logging
+import os
+import sys
+import time
+
+import isodate
+
+from util import (
+    BOUNDING_BOX, LOAD_PATH, TNDS_REGIONS, API_SCHEMA, get_client, get_stops
+)
+from create_csv import emit_csv
+from expand_merged import expand, emit_json
+from extract_stops import lookup_stops, emit_stops
+from get_journeys import get_journeys
+from get_trips import KEY_FIELDS, add_records, day_window, derive_timings, finish_trips
+from merge import do_merge, clasify_matches, emit_merged
+from sirivm import FileIndex, file_timestamp, interesting_records
+from trajectory import score_matches
+from trip import UK_LOCAL, Trip
+
+logger = logging.getLogger('__name__')
+
+# How often to look for new files (seconds)
+POLL_INTERVAL = 30
+
+# Ignore files modified more recently than this, in case they are
+# still being written (seconds)
+SETTLE_TIME = 10
+
+# A trip is complete once there have been no positions for it for
+# this long (seconds)
+IDLE_TIMEOUT = 20 * 60
+
+# How often to write out provisional results (seconds)
+EMIT_INTERVAL = 5 * 60
+
+
+def trip_key(trip):
+    '''
+    The key of a SIRI-VM record's, or a Trip's, trip (see add_records())
+    '''
+    return tuple(trip[field] for field in KEY_FIELDS)
+
+
+class LiveTrips(object):
+    '''
+    Incremental version of get_trips and derive_timings for one day
+    '''
+
+    def __init__(self, client, schema, day, interesting_stops, idle_timeout=IDLE_TIMEOUT):
+        self.client = client
+        self.schema = schema
+        self.day = day
+        self.start, self.end = day_window(day)
+        self.interesting_stops = interesting_stops
+        self.idle_timeout = idle_timeout
+        # Trips still running, by key
+        self.running = {}
+        # Timestamp of the file in which each running trip was last
+        # seen, least recently seen first
+        self.last_seen = collections.OrderedDict()
+        # Finished trips that start on the day, by key
+        self.completed = {}
+        # Whether positions for trips due to depart on other days are
+        # accepted (see close()), and whether each departure time seen
+        # since is on the day
+        self.open = True
+        self.departures = {}
+
+    def add_file(self, filename, records=None):
+        '''
+        Add the positions from a new SIRI-VM file (or the interesting
+        records already read from it), and complete any trips that
+        haven't been seen since IDLE_TIMEOUT before it
+
+        Positions for a trip that has already been completed, because it
+        went quiet for IDLE_TIMEOUT before reporting again, are added to
+        the completed trip and its timings derived again. Once the day
+        has been closed, positions for trips due to depart on other days
+        are ignored.
+        '''
+
+        if records is None:
+            records = interesting_records(filename, self.interesting_stops)
+        if not self.open:
+            records = (record for record in records
+                       if self.departs_in_day(record['OriginAimedDepartureTime']))
+
+        timestamp = file_timestamp(filename)
+        late = []
+        for key in add_records(self.running, records):
+            if key in self.completed:
+                trip = self.completed[key]
+                trip.extend(self.running.pop(key))
+                trip.finish()
+                late.append(trip)
+            else:
+                self.last_seen[key] = timestamp
+                self.last_seen.move_to_end(key)
+        if late:
+            logger.info('Added late positions to %s completed trips', len(late))
+            derive_timings(late)
+
+        idle = []
+        for key, seen in self.last_seen.items():
+            if seen > timestamp - self.idle_timeout:
+                break
+            idle.append(key)
+        self.complete(idle)
+
+    def close(self):
+        '''
+        Once the day is over, only accept positions for trips due to
+        depart on it. Trips still running carry on until they complete,
+        so those that run past midnight (or are first seen after it) are
+        collected in full from the following day's files, and the day is
+        finished once 'running' is empty.
+        '''
+        self.open = False
+
+    def departs_in_day(self, departure):
+        '''
+        Whether an OriginAimedDepartureTime is on the day
+        '''
+        if departure not in self.departures:
+            self.departures[departure] = self.start <= isodate.parse_datetime(departure) < self.end
+        return self.departures[departure]
+
+    def complete(self, keys=None):
+        '''
+        Complete the running trips with the given keys, or all of them
+        '''
+
+        if keys is None:
+            keys = list(self.running)
+        if not keys:
+            return
+
+        trips = {}
+        for key in keys:
+            trips[key] = self.running.pop(key)
+            del self.last_seen[key]
+
+        trips = finish_trips(self.client, self.schema, self.start, self.end,
+                             trips, self.interesting_stops)
+        derive_timings(trips)
+        for trip in trips:
+            self.completed[trip_key(trip)] = trip
+
+    def trips(self):
+        '''
+        Return a list of the completed trips together with provisional
+        versions of those still running
+        '''
+
+        provisional = {
+            key: Trip.from_columns(trip, trip.latitude, trip.longitude,
+                                   trip.timestamp, trip.bearing, trip.delay,
+                                   trip.duplicates)
+            for key, trip in self.running.items()
+        }
+        provisional = finish_trips(self.client, self.schema, self.start, self.end,
+                                   provisional, self.interesting_stops)
+        derive_timings(provisional)
+        return list(self.completed.values()) + provisional
+
+
+def emit_results(client, schema, day, interesting_stops, journeys, trips):
+    '''
+    Match trips to journeys and write out the results, as
+    do_everything.py does
+    '''
+
+    merged = do_merge(trips, journeys)
+    clasify_matches(merged)
+    all_stops = lookup_stops(client, schema, merged, interesting_stops)
+    score_matches(merged, all_stops)
+    rows = expand(day, merged, all_stops)
+
+    emit_merged(day, BOUNDING_BOX, merged)
+    emit_stops(day, BOUNDING_BOX, all_stops)
+    emit_json(day, BOUNDING_BOX, rows)
+    emit_csv(day, rows)
+
+
+def new_files(index, day, after, settle=True):
+    '''
+    Return the timestamps and names of the files in day's directory
+    with timestamps after 'after', excluding any modified in the last
+    SETTLE_TIME seconds if 'settle' is True
+    '''
+
+    timestamps, filenames = index.day(day)
+    first = bisect.bisect_right(timestamps, after)
+    result = []
+    for timestamp, filename in zip(timestamps[first:], filenames[first:]):
+        if settle and os.stat(filename).st_mtime > time.time() - SETTLE_TIME:
+            break
+        result.append((timestamp, filename))
+    return result
+
+
+def main():
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    logger.info('Start')
+
+    try:
+        day = (datetime.datetime.strptime(sys.argv[1], '%Y-%m-%d').date()
+               if len(sys.argv) > 1 else datetime.datetime.now(UK_LOCAL).date())
+    except ValueError:
+        logger.error('Failed to parse date')
+        sys.exit(1)
+
+    # Setup a coreapi client
+    client = get_client()
+    schema = client.get(API_SCHEMA)
+
+    # Get the list of all the stops we are interested in
+    interesting_stops = get_stops(client, schema, BOUNDING_BOX)
+    if len(interesting_stops) == 0:
+        logger.error('Failed to get any stops')
+        sys.exit(2)
+
+    index = FileIndex(LOAD_PATH)
+
+    # Earlier days that are over but still have trips running, and
+    # their journeys
+    closing = []
+
+    while True:
+
+        logger.info('Processing %s', day)
+
+        journeys = get_journeys(day, interesting_stops, TNDS_REGIONS)
+        live = LiveTrips(client, schema, day, interesting_stops)
+        _, day_end = day_window(day)
+        last_file = 0
+        last_emit = time.time()
+        changed = False
+
+        while True:
+
+            # Once the day is over (allowing time for its last files to
+            # appear) read whatever is left and finish
+            over = datetime.datetime.now(UK_LOCAL) > day_end + datetime.timedelta(seconds=POLL_INTERVAL + SETTLE_TIME)
+
+            for last_file, filename in new_files(index, day, last_file, settle=not over):
+                logger.debug('Processing %s', filename)
+                try:
+                    records = list(interesting_records(filename, interesting_stops))
+                except ValueError:
+                    logger.exception('Failed to read %s - skipping it', filename)
+                    continue
+                live.add_file(filename, records)
+                for previous, _ in closing:
+                    previous.add_file(filename, records)
+                changed = True
+
+            # Earlier days are finished once their last trips complete
+            for previous, previous_journeys in [pair for pair in closing if not pair[0].running]:
+                logger.info('Writing final results for %s', previous.day)
+                emit_results(client, schema, previous.day, interesting_stops,
+                             previous_journeys, previous.trips())
+                closing.remove((previous, previous_journeys))
+
+            if over:
+                break
+
+            if changed and time.time() - last_emit >= EMIT_INTERVAL:
+                logger.info('Writing provisional results for %s', day)
+                emit_results(client, schema, day, interesting_stops, journeys, live.trips())
+                last_emit = time.time()
+                changed = False
+
+            time.sleep(POLL_INTERVAL)
+
+        # Trips still running a whole day later never will finish:
+        # complete them so that their day's results are written out
+        for previous, _ in closing:
+            previous.complete()
+
+        # Carry this day's running trips on into the next day's files
+        live.close()
+        closing.append((live, journeys))
+
+        day += datetime.timedelta(days=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,12 +10,24 @@ matched journeys and trips (as merged-<YYYY>-<mm>-<dd>.json).
 
 import collections
 import datetime
+import heapq
 import json
 import logging
 import sys
 
+import isodate
+
+from spatial import Clusters
+from trip import json_default
+from util import MERGE_EQUIVALENT_STOPS, MERGE_TOLERANCE, get_stop_clusters
+
 logger = logging.getLogger('__name__')
 
+# Score added to a fuzzy match for each of its origin and destination
+# that isn't the same stop, equivalent to this many seconds difference
+# in departure time
+STOP_PENALTY = 60
+
 
 def load_trips(day):
 
@@ -43,16 +55,132 @@ def load_journeys(day):
     return journeys
 
 
-def do_merge(trips, journeys):
+def load_stop_classes(filename, clusters=None):
+    '''
+    Return a dictionary mapping ATCOCodes to the ids of their classes:
+    the stop clusters 'clusters' (see util.get_stop_clusters()) with
+    each list of stops in the JSON file 'filename' (if given) joined
+    into the same class
+    '''
+
+    classes = Clusters(clusters)
+
+    if filename:
+        with open(filename, 'r', newline='') as jsonfile:
+            for stops in json.load(jsonfile):
+                for stop in stops:
+                    classes.join(stops[0], stop)
+
+    return classes.as_dict()
+
+
+def fuzzy_pairs(trip_keys, journey_keys, tolerance, stop_class):
+    '''
+    Pair trip keys with journey keys (both (departure time, origin,
+    destination)) whose departure times are within 'tolerance' seconds
+    of each other and whose origins and destinations are in the same
+    classes according to 'stop_class'
+
+    Pairs are scored by the difference in departure time plus
+    STOP_PENALTY for each stop that isn't the same, and made best
+    first, each key being used at most once.
+
+    Journeys and trips are put in lists sorted by departure time: one
+    for each pair of origin and destination classes, and within that
+    one for each origin stop, each destination stop and each pair of
+    them. The best pair left is always next to each other in one of
+    these lists (anything between them in the list for the stops they
+    share would make a pair at least as good), so only neighbouring
+    journeys and trips are scored. Paired keys are unlinked from their
+    lists, and their former neighbours scored against each other, so
+    the whole takes O(n log n) time however wide the tolerance.
+    '''
+
+    def class_of(stop):
+        return stop_class.get(stop, stop)
+
+    lists = collections.defaultdict(list)
+    for is_trip, keys in ((False, journey_keys), (True, trip_keys)):
+        for key in keys:
+            classes = (class_of(key[1]), class_of(key[2]))
+            entry = (departure_seconds(key[0]), is_trip, key)
+            for name in (classes, classes + (key[1], None),
+                         classes + (None, key[2]), classes + (key[1], key[2])):
+                lists[name].append(entry)
+
+    # The lists end to end as doubly linked lists, with the places
+    # each key appears in them
+    entries = []
+    before = []
+    after = []
+    places = collections.defaultdict(list)
+    for entry_list in lists.values():
+        entry_list.sort()
+        start = len(entries)
+        for n, entry in enumerate(entry_list):
+            places[entry[1:]].append(start + n)
+            entries.append(entry)
+            before.append(start + n - 1 if n > 0 else -1)
+            after.append(start + n + 1 if n < len(entry_list) - 1 else -1)
+
+    candidates = []
+
+    def add_candidate(first, second):
+        if first < 0 or second < 0 or entries[first][1] == entries[second][1]:
+            return
+        (journey_time, _, journey_key), (trip_time, _, trip_key) = sorted(
+            (entries[first], entries[second]), key=lambda entry: entry[1])
+        difference = abs(trip_time - journey_time)
+        if difference <= tolerance:
+            score = (difference +
+                     STOP_PENALTY * ((trip_key[1] != journey_key[1]) + (trip_key[2] != journey_key[2])))
+            heapq.heappush(candidates, (score, journey_key, trip_key))
+
+    for n in range(len(entries)):
+        add_candidate(n, after[n])
+
+    pairs = []
+    paired_journeys = set()
+    paired_trips = set()
+    while candidates:
+        score, journey_key, trip_key = heapq.heappop(candidates)
+        if journey_key in paired_journeys or trip_key in paired_trips:
+            continue
+        pairs.append((journey_key, trip_key))
+        paired_journeys.add(journey_key)
+        paired_trips.add(trip_key)
+        for n in places[(False, journey_key)] + places[(True, trip_key)]:
+            if before[n] >= 0:
+                after[before[n]] = after[n]
+            if after[n] >= 0:
+                before[after[n]] = before[n]
+            add_candidate(before[n], after[n])
+
+    return pairs
+
+
+def departure_seconds(departure):
+    return isodate.parse_datetime(departure).timestamp()
+
+
+def do_merge(trips, journeys, tolerance=MERGE_TOLERANCE, stop_class=None):
     '''
     Merge trips and journeys into one list, matching those with
     identical departure time, origin and destination
+
+    Trips and journeys that don't match exactly are then matched if
+    their departure times are within 'tolerance' seconds and their
+    origins and destinations are equivalent according to 'stop_class'
+    (a dictionary mapping stops to the ids of their classes; by default
+    the stop clusters for MERGE_CLUSTER_RADIUS joined with the lists in
+    MERGE_EQUIVALENT_STOPS) - see fuzzy_pairs()
     '''
 
+    if stop_class is None:
+        stop_class = load_stop_classes(MERGE_EQUIVALENT_STOPS, get_stop_clusters())
+
     # Group trips by OriginAimedDepartureTime/OriginRef/DestinationRef
-    # and create a sorted list of keys
     trip_index = collections.defaultdict(list)
-    trip_list = []
     for trip in trips:
         key = (
             trip['OriginAimedDepartureTime'],
@@ -60,12 +188,10 @@ def do_merge(trips, journeys):
             trip['DestinationRef']
         )
         trip_index[key].append(trip)
-    trip_list = sorted(trip_index.keys())
-    logger.info('Grouped %s trips into %s groups', len(trips), len(trip_list))
+    logger.info('Grouped %s trips into %s groups', len(trips), len(trip_index))
 
     # Dito for journeys, grouped by DepartureTime and first and last stop
     journey_index = collections.defaultdict(list)
-    journey_list = []
     for journey in journeys:
         key = (
             journey['DepartureTime'],
@@ -73,46 +199,47 @@ def do_merge(trips, journeys):
             journey['stops'][-1]['StopPointRef']
         )
         journey_index[key].append(journey)
-    journey_list = sorted(journey_index.keys())
-    logger.info('Grouped %s journeys into %s groups', len(journeys), len(journey_list))
+    logger.info('Grouped %s journeys into %s groups', len(journeys), len(journey_index))
 
     # Merge trips and journeys into one list that has one element per distinct
     # departure time/origin/destination and whose first column contains a
     # (possibly empty) list of trips and whose second column contains a
     # (possibly empty) list of journeys
-    results = []
-    while trip_list and journey_list:
-        if trip_list[0] < journey_list[0]:
-            results.append({
-                'trips': trip_index[trip_list.pop(0)],
-                'journeys': []
-            })
-        elif trip_list[0] > journey_list[0]:
-            results.append({
-                'trips': [],
-                'journeys': journey_index[journey_list.pop(0)]
-            })
-        else:
-            results.append({
-                'trips': trip_index[trip_list.pop(0)],
-                'journeys': journey_index[journey_list.pop(0)]
-            })
-    while trip_list:
-        results.append({
-            'trips': trip_index[trip_list.pop(0)],
-            'journeys': []
-        })
-    while journey_list:
-        results.append({
-            'trips': [],
-            'journeys': journey_index[journey_list.pop(0)]
-        })
+    merged = {}
+    for key in trip_index.keys() | journey_index.keys():
+        merged[key] = {
+            'trips': trip_index.get(key, []),
+            'journeys': journey_index.get(key, [])
+        }
+
+    # Then match up the groups left over, keeping the journeys' key
+    if tolerance > 0 or stop_class:
+        pairs = fuzzy_pairs(
+            [key for key in trip_index if key not in journey_index],
+            [key for key in journey_index if key not in trip_index],
+            tolerance, stop_class)
+        for journey_key, trip_key in pairs:
+            merged[journey_key]['trips'] = merged.pop(trip_key)['trips']
+        logger.info('Matched %s more groups with tolerance %ss and %s classified stops',
+                    len(pairs), tolerance, len(stop_class))
+
+    results = [merged[key] for key in sorted(merged)]
 
     logger.info('Created %s merged records', len(results))
 
     return results
 
 
+def match_type(journeys, trips):
+    '''
+    Return the type string for a match: the number of journeys and of
+    trips ('*' for more than one), e.g. '1-*'
+    '''
+    return ((str(len(journeys)) if len(journeys) <= 1 else '*') +
+            '-' +
+            (str(len(trips)) if len(trips) <= 1 else '*'))
+
+
 def clasify_matches(merged):
     '''
     Add a type field to matches
@@ -124,9 +251,7 @@ def clasify_matches(merged):
         trips = merge['trips']
         journeys = merge['journeys']
         # Derive the type string
-        type = ((str(len(journeys)) if len(journeys) <= 1 else '*') +
-                '-' +
-                (str(len(trips)) if len(trips) <= 1 else '*'))
+        type = match_type(journeys, trips)
         merge['type'] = type
         logger.debug('jlen %s, tlen %s, type %s', len(journeys), len(trips), type)
 
@@ -147,7 +272,7 @@ def emit_merged(day, bounding_box, results):
             'bounding_box': bounding_box,
             'merged': results
         }
-        json.dump(output, jsonfile, indent=4, sort_keys=True)
+        json.dump(output, jsonfile, indent=4, sort_keys=True, default=json_default)
 
     logger.info('Output done')
 
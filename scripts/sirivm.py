@@ -0,0 +1,234 @@
+'''
+Read archived SIRI-VM data
+
+SIRI-VM position reports are archived as JSON files, one per minute,
+in a LOAD_PATH/yyyy/mm/dd/ directory per day. Each file contains a
+single object whose "request_data" member is a list of position
+records (see get_trips.py for an example). Files are named
+<timestamp>_yyyy-mm-dd-hh-mm-ss.json, where <timestamp> is the time
+of the snapshot in seconds since the epoch.
+'''
+
+import bisect
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger('__name__')
+
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+
+_space = re.compile(r'[ \t\r\n]*')
+_separator = re.compile(r'[ \t\r\n,]*')
+_value = re.compile(r'\s*:\s*"([^"\\]*)"')
+
+
+def day_files(load_path, date):
+    '''
+    Return a sorted list of the SIRI-VM files for 'date' in load_path
+    '''
+    path = os.path.join(
+        load_path, date.strftime('%Y'), date.strftime('%m'),
+        date.strftime('%d'), '*.json')
+    return sorted(glob.glob(path))
+
+
+def file_timestamp(filename):
+    '''
+    Return the timestamp from the name of a SIRI-VM file, or None if it
+    doesn't have one
+    '''
+    try:
+        return int(os.path.basename(filename).split('_', 1)[0])
+    except ValueError:
+        return None
+
+
+class FileIndex(object):
+    '''
+    Index of the SIRI-VM files in load_path by the timestamps in their
+    names
+
+    Each day's directory is listed when it's first needed, and again
+    only if it has changed since.
+    '''
+
+    def __init__(self, load_path):
+        self.load_path = load_path
+        # Directory -> (modification time, sorted timestamps, filenames)
+        self.directories = {}
+
+    def day(self, date):
+        '''
+        Return sorted lists of the timestamps and the corresponding
+        names of the files in the directory for 'date'
+        '''
+
+        directory = os.path.join(
+            self.load_path, date.strftime('%Y'), date.strftime('%m'), date.strftime('%d'))
+        try:
+            mtime = os.stat(directory).st_mtime
+        except FileNotFoundError:
+            return [], []
+
+        entry = self.directories.get(directory)
+        if entry is None or entry[0] != mtime:
+            files = []
+            for name in os.listdir(directory):
+                timestamp = file_timestamp(name)
+                if name.endswith('.json') and timestamp is not None:
+                    files.append((timestamp, os.path.join(directory, name)))
+            files.sort()
+            entry = (mtime, [f[0] for f in files], [f[1] for f in files])
+            self.directories[directory] = entry
+
+        return entry[1], entry[2]
+
+    def files(self, start, end):
+        '''
+        Return the names of the files with timestamps from 'start' up to
+        but not including 'end' (both aware datetimes) in time order
+        '''
+
+        start_timestamp = start.timestamp()
+        end_timestamp = end.timestamp()
+
+        # Directories are named by date in local time, so look in those
+        # either side of the window to be sure of catching every file
+        result = []
+        date = start.date() - datetime.timedelta(days=1)
+        while date <= end.date() + datetime.timedelta(days=1):
+            timestamps, filenames = self.day(date)
+            first = bisect.bisect_left(timestamps, start_timestamp)
+            last = bisect.bisect_left(timestamps, end_timestamp)
+            result.extend(zip(timestamps[first:last], filenames[first:last]))
+            date += datetime.timedelta(days=1)
+
+        return [filename for _, filename in sorted(result)]
+
+
+def read_records(filename, interesting_stops=None):
+    '''
+    Yield the records from the "request_data" list in a SIRI-VM JSON
+    file one at a time
+
+    The file is read and decoded incrementally so only the current
+    record, and at most a chunk of the file, are held in memory
+    however large the file is.
+
+    Given interesting_stops, records whose OriginRef and DestinationRef
+    are both plainly not in it are skipped without being decoded (see
+    skip_record()). Others may still need to be checked.
+    '''
+
+    with open(filename) as data_file:
+
+        buffer = ''
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            chunk = data_file.read(CHUNK_SIZE)
+            if not chunk:
+                eof = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def skip(characters):
+            # Skip over any of characters (a compiled pattern matching
+            # a run of them), reading more if needed, and return the
+            # next character (or '' at the end of the file)
+            nonlocal pos
+            while True:
+                pos = characters.match(buffer, pos).end()
+                if pos < len(buffer) or eof:
+                    return buffer[pos:pos + 1]
+                fill()
+
+        # Find the start of the request_data list
+        key = '"request_data"'
+        while True:
+            found = buffer.find(key, pos)
+            if found < 0:
+                if eof:
+                    logger.warning('No request_data list in %s', filename)
+                    return
+                # Keep enough to match a key split across chunks
+                pos = max(pos, len(buffer) - len(key))
+                fill()
+                continue
+            pos = found + len(key)
+            if skip(_space) != ':':
+                continue
+            pos += 1
+            if skip(_space) == '[':
+                pos += 1
+                break
+
+        # Decode each record as soon as all of it has been read
+        while True:
+            character = skip(_separator)
+            if character == ']':
+                return
+            if character == '':
+                raise ValueError('Truncated request_data in %s' % filename)
+            if interesting_stops is not None:
+                end = buffer.find('}', pos)
+                if end < 0 and not eof:
+                    fill()
+                    continue
+                if end >= 0 and skip_record(buffer, pos, end + 1, interesting_stops):
+                    pos = end + 1
+                    continue
+            try:
+                record, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            pos = end
+            yield record
+
+
+def skip_record(buffer, start, end, interesting_stops):
+    '''
+    Return True if the record assumed to be buffer[start:end] can be
+    skipped because neither its OriginRef nor its DestinationRef is in
+    interesting_stops
+
+    Records are flat objects, so this is the whole record unless a
+    string in it contains a '}'. Anything out of the ordinary (escapes,
+    nested objects, an odd number of quotes, or a missing field) isn't
+    skipped, leaving the record to be decoded and checked in full.
+    '''
+
+    if (buffer.find('\\', start, end) >= 0 or buffer.find('{', start + 1, end) >= 0 or
+            buffer.count('"', start, end) % 2):
+        return False
+    for field in ('"OriginRef"', '"DestinationRef"'):
+        found = buffer.find(field, start, end)
+        if found < 0:
+            return False
+        value = _value.match(buffer, found + len(field), end)
+        if value is None or value.group(1) in interesting_stops:
+            return False
+    return True
+
+
+def interesting_records(filename, interesting_stops):
+    '''
+    Yield the records in a SIRI-VM JSON file for which at least one of
+    the origin or destination is in interesting_stops
+    '''
+
+    for record in read_records(filename, interesting_stops):
+        if (record['OriginRef'] in interesting_stops or
+                record['DestinationRef'] in interesting_stops):
+            yield record
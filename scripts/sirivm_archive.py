@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+'''
+Consolidated daily SIRI-VM archive
+
+A day's SIRI-VM data arrives as well over a thousand small JSON files
+(see sirivm.py), all of which have to be opened and parsed every time
+the day is processed. This module converts them into a single NumPy
+.npz file per day, SIRIVM_ARCHIVE_PATH/yyyy-mm-dd.npz, holding just the
+data that get_trips needs as one array per field in file order:
+
+  * the trip fields (trip.TRIP_FIELDS) dictionary encoded, as an int32
+    array of codes '<field>' and an array '<field>_values' of the
+    distinct strings that they index
+  * 'latitude' and 'longitude' (float64), 'timestamp' (int64 epoch
+    seconds, from acp_ts), 'bearing' (int16) and 'delay' (int32
+    seconds, trip.NO_DELAY if invalid), as held by trip.Trip
+  * 'files', the names of the JSON files the archive was built from
+
+get_trips reads the archive instead of the JSON files if there is one
+for the day it's processing that was built from the same files.
+
+Run as a script, this consolidates one day, or every day in a range:
+
+    sirivm_archive.py 2018-10-13 [2018-10-20]
+'''
+
+import datetime
+import logging
+import os
+import sys
+
+import numpy
+
+from sirivm import day_files, read_records
+from trip import NO_DELAY, TRIP_FIELDS, parse_bearing, parse_delay
+
+logger = logging.getLogger('__name__')
+
+# Position arrays and their types
+POSITION_COLUMNS = (
+    ('latitude', numpy.float64),
+    ('longitude', numpy.float64),
+    ('timestamp', numpy.int64),
+    ('bearing', numpy.int16),
+    ('delay', numpy.int32),
+)
+
+
+def archive_filename(archive_path, date):
+    return os.path.join(archive_path, '{:%Y-%m-%d}.npz'.format(date))
+
+
+def write_archive(filename, sources):
+    '''
+    Consolidate the records in the SIRI-VM files 'sources' into a
+    new archive 'filename'. Return the number of records
+    '''
+
+    codes = {field: [] for field in TRIP_FIELDS}
+    values = {field: {} for field in TRIP_FIELDS}
+    columns = {name: [] for name, _ in POSITION_COLUMNS}
+
+    for source in sources:
+        logger.debug('Archiving %s', source)
+        for record in read_records(source):
+            for field in TRIP_FIELDS:
+                codes[field].append(values[field].setdefault(record[field], len(values[field])))
+            columns['latitude'].append(float(record['Latitude']))
+            columns['longitude'].append(float(record['Longitude']))
+            columns['timestamp'].append(int(record['acp_ts']))
+            columns['bearing'].append(parse_bearing(record['Bearing']))
+            columns['delay'].append(parse_delay(record['Delay']))
+
+    arrays = {'files': numpy.array([os.path.basename(source) for source in sources], dtype=str)}
+    for field in TRIP_FIELDS:
+        arrays[field] = numpy.array(codes[field], dtype=numpy.int32)
+        # Values in order of their codes
+        arrays[field + '_values'] = numpy.array(list(values[field]), dtype=str)
+    for name, dtype in POSITION_COLUMNS:
+        arrays[name] = numpy.array(columns[name], dtype=dtype)
+
+    invalid = int(numpy.count_nonzero(arrays['delay'] == NO_DELAY))
+    if invalid:
+        logger.warning('%s records with an invalid Delay', invalid)
+
+    # Write to a temporary file and rename it so that get_trips never
+    # sees a partial archive
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    temporary = filename + '.tmp.npz'
+    numpy.savez_compressed(temporary, **arrays)
+    os.replace(temporary, filename)
+
+    return len(arrays['timestamp'])
+
+
+def read_archive(filename, sources=None):
+    '''
+    Return a dictionary of the arrays in archive 'filename', or None if
+    there isn't one or, given a list of SIRI-VM files 'sources', if it
+    wasn't built from exactly those files
+    '''
+
+    if not os.path.exists(filename):
+        return None
+
+    with numpy.load(filename, allow_pickle=False) as archive:
+        arrays = {name: archive[name] for name in archive.files}
+
+    if (sources is not None and
+            arrays['files'].tolist() != [os.path.basename(source) for source in sources]):
+        logger.warning('%s is out of date - ignoring it', filename)
+        return None
+
+    return arrays
+
+
+def main():
+
+    from util import LOAD_PATH, SIRIVM_ARCHIVE_PATH
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    logger.info('Start')
+
+    if not SIRIVM_ARCHIVE_PATH:
+        logger.error('SIRIVM_ARCHIVE_PATH not set')
+        sys.exit(1)
+
+    try:
+        start = datetime.datetime.strptime(sys.argv[1], '%Y-%m-%d').date()
+        end = (datetime.datetime.strptime(sys.argv[2], '%Y-%m-%d').date()
+               if len(sys.argv) > 2 else start)
+    except (IndexError, ValueError):
+        logger.error('Usage: %s YYYY-MM-DD [YYYY-MM-DD]', sys.argv[0])
+        sys.exit(1)
+
+    day = start
+    while day <= end:
+        sources = day_files(LOAD_PATH, day)
+        if sources:
+            filename = archive_filename(SIRIVM_ARCHIVE_PATH, day)
+            records = write_archive(filename, sources)
+            logger.info('Archived %s records from %s files to %s', records, len(sources), filename)
+        else:
+            logger.warning('No SIRI-VM files for %s', day)
+        day += datetime.timedelta(days=1)
+
+    logger.info('Stop')
+
+
+if __name__ == '__main__':
+    main()
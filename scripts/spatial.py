@@ -0,0 +1,272 @@
+'''
+Spatial index of bus stops, and areas defined by polygons
+
+StopIndex puts stops (as returned by util.get_stops()) into a uniform
+grid of roughly square cells so that the stops near a point can be
+found by looking in just a few cells: the nearest stop to a position,
+all the stops within some distance of it, or all the stops inside an
+Area.
+
+An Area is one or more polygons, read from a GeoJSON file (a Polygon,
+MultiPolygon, Feature or FeatureCollection of them). This allows
+catchments other than the rectangular BOUNDING_BOX.
+
+stop_clusters() groups stops that are in the same NaPTAN stop area or
+close to one another, such as the stops around an interchange, so
+that merge can treat them as the same stop.
+'''
+
+import json
+import logging
+import math
+
+from haversine import haversine
+
+logger = logging.getLogger('__name__')
+
+# Approximate length of a degree of latitude, in metres
+METRES_PER_DEGREE = 111320.0
+
+# The field of a stop record holding its NaPTAN stop area. The stop
+# records returned by the API (see DESCRIPTION.md) don't currently
+# include one, in which case stops are clustered by distance alone.
+STOP_AREA_FIELD = 'stop_area_code'
+
+
+class Area(object):
+    '''
+    One or more polygons, each a list of rings of (longitude,
+    latitude) points: the first ring is the outline, any others holes
+    in it
+    '''
+
+    def __init__(self, polygons):
+        self.polygons = polygons
+        points = [point for polygon in polygons for point in polygon[0]]
+        self.bbox = (min(p[0] for p in points), min(p[1] for p in points),
+                     max(p[0] for p in points), max(p[1] for p in points))
+
+    @classmethod
+    def from_geojson(cls, filename):
+        with open(filename, 'r', newline='') as jsonfile:
+            geojson = json.load(jsonfile)
+        polygons = []
+        features = geojson.get('features', [geojson])
+        for feature in features:
+            geometry = feature.get('geometry', feature)
+            if geometry['type'] == 'Polygon':
+                polygons.append(geometry['coordinates'])
+            elif geometry['type'] == 'MultiPolygon':
+                polygons.extend(geometry['coordinates'])
+            else:
+                raise ValueError('Unsupported geometry %s in %s' % (geometry['type'], filename))
+        return cls(polygons)
+
+    @property
+    def bounding_box(self):
+        '''
+        The area's bounding box as a BOUNDING_BOX-style string
+        '''
+        return '%f,%f,%f,%f' % self.bbox
+
+    def contains(self, lat, lng):
+        if not (self.bbox[0] <= lng <= self.bbox[2] and self.bbox[1] <= lat <= self.bbox[3]):
+            return False
+        for polygon in self.polygons:
+            if in_ring(lat, lng, polygon[0]) and not any(in_ring(lat, lng, hole) for hole in polygon[1:]):
+                return True
+        return False
+
+
+def in_ring(lat, lng, ring):
+    '''
+    Return True if (lat, lng) is inside the ring of (longitude, latitude)
+    points, by counting crossings of a ray from it
+    '''
+    inside = False
+    x1, y1 = ring[-1][0], ring[-1][1]
+    for point in ring:
+        x2, y2 = point[0], point[1]
+        if (y2 > lat) != (y1 > lat) and lng < (x1 - x2) * (lat - y2) / (y1 - y2) + x2:
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+
+def stop_position(stop):
+    '''
+    Return the (latitude, longitude) of a stop, or None if it doesn't
+    have one
+    '''
+    try:
+        return float(stop['latitude']), float(stop['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class StopIndex(object):
+    '''
+    Grid index of a dictionary of stops keyed by ATCOCode, with cells
+    of about cell_size metres square
+    '''
+
+    def __init__(self, stops, cell_size=250):
+
+        positions = {code: stop_position(stop) for code, stop in stops.items()}
+        positions = {code: position for code, position in positions.items() if position}
+
+        self.stops = stops
+        self.cell_size = cell_size
+        self.lat_step = cell_size / METRES_PER_DEGREE
+        mean_lat = (sum(p[0] for p in positions.values()) / len(positions)) if positions else 0.0
+        self.lng_step = cell_size / (METRES_PER_DEGREE * math.cos(math.radians(mean_lat)))
+
+        self.cells = {}
+        for code, position in positions.items():
+            self.cells.setdefault(self.cell(*position), []).append((code, position))
+
+        if self.cells:
+            rows = [cell[0] for cell in self.cells]
+            columns = [cell[1] for cell in self.cells]
+            self.extent = (min(rows), min(columns), max(rows), max(columns))
+
+    def __len__(self):
+        return sum(len(cell) for cell in self.cells.values())
+
+    def cell(self, lat, lng):
+        return int(math.floor(lat / self.lat_step)), int(math.floor(lng / self.lng_step))
+
+    def _ring(self, centre, radius):
+        '''
+        Yield the contents of the cells 'radius' cells from 'centre'
+        '''
+        row, column = centre
+        for r in range(row - radius, row + radius + 1):
+            if r in (row - radius, row + radius):
+                columns = range(column - radius, column + radius + 1)
+            else:
+                columns = (column - radius, column + radius)
+            for c in columns:
+                yield from self.cells.get((r, c), ())
+
+    def within(self, lat, lng, radius):
+        '''
+        Return a list of (distance, ATCOCode) for the stops within
+        'radius' metres of (lat, lng), nearest first
+        '''
+
+        centre = self.cell(lat, lng)
+        result = []
+        for ring in range(int(math.ceil(radius / self.cell_size)) + 1):
+            for code, position in self._ring(centre, ring):
+                distance = haversine((lat, lng), position) * 1000
+                if distance <= radius:
+                    result.append((distance, code))
+        return sorted(result)
+
+    def nearest(self, lat, lng, max_distance=None):
+        '''
+        Return (distance, ATCOCode) for the stop nearest to (lat, lng),
+        or None if there isn't one (within max_distance metres)
+        '''
+
+        if not self.cells:
+            return None
+
+        centre = self.cell(lat, lng)
+        # Rings that need searching to cover the whole grid
+        rings = max(abs(centre[0] - self.extent[0]), abs(centre[0] - self.extent[2]),
+                    abs(centre[1] - self.extent[1]), abs(centre[1] - self.extent[3]))
+        if max_distance is not None:
+            rings = min(rings, int(math.ceil(max_distance / self.cell_size)))
+
+        best = None
+        for ring in range(rings + 1):
+            # Everything in further rings is at least this far away
+            if best is not None and best[0] <= (ring - 1) * self.cell_size:
+                break
+            for code, position in self._ring(centre, ring):
+                distance = haversine((lat, lng), position) * 1000
+                if best is None or (distance, code) < best:
+                    best = (distance, code)
+
+        if best is None or (max_distance is not None and best[0] > max_distance):
+            return None
+        return best
+
+    def in_area(self, area):
+        '''
+        Return a dictionary of the stops inside an Area
+        '''
+
+        min_row, min_column = self.cell(area.bbox[1], area.bbox[0])
+        max_row, max_column = self.cell(area.bbox[3], area.bbox[2])
+        result = {}
+        for (row, column), cell in self.cells.items():
+            if min_row <= row <= max_row and min_column <= column <= max_column:
+                for code, position in cell:
+                    if area.contains(*position):
+                        result[code] = self.stops[code]
+        return result
+
+
+class Clusters(object):
+    '''
+    Stops joined into clusters (a union-find structure), starting from
+    a dictionary mapping ATCOCodes to cluster ids as returned by
+    as_dict(). Each cluster is identified by its lowest ATCOCode.
+    '''
+
+    def __init__(self, clusters=None):
+        self.parent = dict(clusters or {})
+
+    def find(self, code):
+        self.parent.setdefault(code, code)
+        while self.parent[code] != code:
+            self.parent[code] = self.parent[self.parent[code]]
+            code = self.parent[code]
+        return code
+
+    def join(self, code, other):
+        code, other = self.find(code), self.find(other)
+        if code != other:
+            self.parent[max(code, other)] = min(code, other)
+
+    def as_dict(self):
+        return {code: self.find(code) for code in self.parent}
+
+
+def stop_clusters(stops, radius):
+    '''
+    Return a dictionary mapping the ATCOCode of each of a dictionary of
+    stops to the id of its cluster (its lowest ATCOCode)
+
+    Stops with the same NaPTAN stop area (STOP_AREA_FIELD) are in the
+    same cluster. Then, taking the stops in ATCOCode order, each one not
+    already in a cluster starts one, and every stop within 'radius'
+    metres of it that isn't already in a cluster joins it. Stops are
+    only joined to a cluster by their distance from the stop that
+    started it, not from any other member, so clusters can't chain
+    along a road of closely spaced stops: a cluster made by distance
+    is at most 2 * 'radius' across.
+    '''
+
+    clusters = {}
+    areas = {}
+    for code in sorted(stops):
+        area = stops[code].get(STOP_AREA_FIELD)
+        if area:
+            clusters[code] = areas.setdefault(area, code)
+    logger.info('%s of %s stops have a stop area (%s)',
+                len(clusters), len(stops), STOP_AREA_FIELD)
+
+    index = StopIndex(stops) if radius else None
+    for code in sorted(stops):
+        if clusters.setdefault(code, code) != code:
+            continue
+        position = stop_position(stops[code]) if index else None
+        if position:
+            for _, other in index.within(*position, radius):
+                clusters.setdefault(other, code)
+
+    return clusters
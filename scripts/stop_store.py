@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+'''
+Persistent store of bus stop details
+
+Stop details (as returned by the SmartCambridge API's transport/stops
+and transport/stop endpoints) change rarely, but every run of every
+script used to retrieve them afresh: a page at a time for all the
+stops in the bounding box, and one request per stop outside it. This
+module keeps them in an SQLite database, STOP_STORE, from which
+util.get_stops() and util.lookup() read them while they are less than
+STOP_TTL days old. With OFFLINE set, stops are only ever read from the
+store, however old, so the scripts can be run without network access
+against a store loaded from a fixture. The stop clusters that merge
+uses (see spatial.stop_clusters()) are built from all the stored stops
+and kept alongside them until the stops change.
+
+Run as a script, this maintains the store:
+
+    stop_store.py refresh        re-retrieve the stops in BOUNDING_BOX
+                                 and any others that have expired, and
+                                 rebuild the stop clusters
+    stop_store.py import FILE    load stops from a JSON file: a
+                                 stops-<yyyy>-<mm>-<dd>.json file, an
+                                 API results page, or a list of stops
+'''
+
+import json
+import logging
+import sqlite3
+import sys
+import time
+
+logger = logging.getLogger('__name__')
+
+
+def parse_bounding_box(bounding_box):
+    '''
+    Return (min longitude, min latitude, max longitude, max latitude)
+    from a 'lng,lat,lng,lat' string
+    '''
+    return tuple(float(value) for value in bounding_box.split(','))
+
+
+class StopStore(object):
+
+    def __init__(self, filename):
+
+        logger.debug('Opening stop store %s', filename)
+        self.connection = sqlite3.connect(filename, timeout=120)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS stop ('
+            'atco_code TEXT PRIMARY KEY, '
+            'latitude REAL, '
+            'longitude REAL, '
+            'fetched REAL NOT NULL, '
+            'data TEXT NOT NULL)')
+        # Bounding boxes for which all the stops have been retrieved
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS area ('
+            'bounding_box TEXT PRIMARY KEY, '
+            'fetched REAL NOT NULL, '
+            'stops TEXT NOT NULL)')
+        # Stop clusters (see spatial.stop_clusters()) for each radius,
+        # with the number of stops and latest fetch time when they were
+        # built so that changes to the stops can be detected
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS stop_cluster ('
+            'radius REAL PRIMARY KEY, '
+            'stop_count INTEGER NOT NULL, '
+            'fetched REAL, '
+            'clusters TEXT NOT NULL)')
+        self.connection.commit()
+
+    def get(self, code, max_age=None):
+        '''
+        Return the stored details of stop 'code', or None if there
+        aren't any or they are more than max_age seconds old
+        '''
+
+        row = self.connection.execute(
+            'SELECT fetched, data FROM stop WHERE atco_code = ?', (code, )).fetchone()
+        if row is None or (max_age is not None and row[0] < time.time() - max_age):
+            return None
+        return json.loads(row[1])
+
+    def put(self, stops, fetched=None):
+        '''
+        Store the details of each of a list of stops
+        '''
+
+        if fetched is None:
+            fetched = time.time()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO stop (atco_code, latitude, longitude, fetched, data) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(stop['atco_code'],
+              float(stop['latitude']) if stop.get('latitude') is not None else None,
+              float(stop['longitude']) if stop.get('longitude') is not None else None,
+              fetched, json.dumps(stop, sort_keys=True))
+             for stop in stops])
+        self.connection.commit()
+
+    def area(self, bounding_box, max_age=None):
+        '''
+        Return a dictionary of the stops in bounding_box, keyed by
+        ATCOCode, if they have all been stored less than max_age
+        seconds ago (see put_area()), otherwise None
+        '''
+
+        row = self.connection.execute(
+            'SELECT fetched, stops FROM area WHERE bounding_box = ?',
+            (bounding_box, )).fetchone()
+        if row is None or (max_age is not None and row[0] < time.time() - max_age):
+            return None
+
+        stops = {}
+        for code in row[1].split():
+            stop = self.get(code)
+            if stop is None:
+                return None
+            stops[code] = stop
+        return stops
+
+    def put_area(self, bounding_box, stops):
+        '''
+        Store a dictionary of all the stops in bounding_box
+        '''
+
+        fetched = time.time()
+        self.put(stops.values(), fetched)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO area (bounding_box, fetched, stops) VALUES (?, ?, ?)',
+            (bounding_box, fetched, ' '.join(sorted(stops))))
+        self.connection.commit()
+
+    def stops_in(self, bounding_box):
+        '''
+        Return a dictionary of all the stored stops that lie within
+        bounding_box, however old
+        '''
+
+        min_lng, min_lat, max_lng, max_lat = parse_bounding_box(bounding_box)
+        return {
+            code: json.loads(data) for code, data in self.connection.execute(
+                'SELECT atco_code, data FROM stop '
+                'WHERE longitude BETWEEN ? AND ? AND latitude BETWEEN ? AND ?',
+                (min_lng, max_lng, min_lat, max_lat))
+        }
+
+    def stops(self):
+        '''
+        Return a dictionary of all the stored stops, however old
+        '''
+
+        return {
+            code: json.loads(data) for code, data in self.connection.execute(
+                'SELECT atco_code, data FROM stop')
+        }
+
+    def _version(self):
+        return self.connection.execute('SELECT COUNT(*), MAX(fetched) FROM stop').fetchone()
+
+    def clusters(self, radius):
+        '''
+        Return the dictionary of stop clusters for 'radius' stored by
+        put_clusters(), or None if there isn't one or the stops have
+        changed since
+        '''
+
+        row = self.connection.execute(
+            'SELECT stop_count, fetched, clusters FROM stop_cluster WHERE radius = ?',
+            (radius, )).fetchone()
+        if row is None or tuple(row[:2]) != tuple(self._version()):
+            return None
+        return json.loads(row[2])
+
+    def put_clusters(self, radius, clusters):
+        '''
+        Store a dictionary of stop clusters for 'radius', built from
+        the stops currently stored
+        '''
+
+        count, fetched = self._version()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO stop_cluster (radius, stop_count, fetched, clusters) '
+            'VALUES (?, ?, ?, ?)',
+            (radius, count, fetched, json.dumps(clusters, sort_keys=True)))
+        self.connection.commit()
+
+    def expired(self, max_age):
+        '''
+        Return a list of the codes of stops stored more than max_age
+        seconds ago
+        '''
+
+        return [code for code, in self.connection.execute(
+            'SELECT atco_code FROM stop WHERE fetched < ? ORDER BY atco_code',
+            (time.time() - max_age, ))]
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def load_fixture(filename):
+    '''
+    Return a list of stops from a stops-<yyyy>-<mm>-<dd>.json file,
+    an API results page, or a JSON list of stops
+    '''
+
+    with open(filename, 'r', newline='') as jsonfile:
+        data = json.load(jsonfile)
+
+    if isinstance(data, dict) and 'stops' in data:
+        data = data['stops']
+    elif isinstance(data, dict) and 'results' in data:
+        data = data['results']
+    if isinstance(data, dict):
+        data = list(data.values())
+
+    return [stop for stop in data if stop and 'atco_code' in stop]
+
+
+def main():
+
+    # Imported here since util itself uses this module
+    from util import (
+        API_SCHEMA, BOUNDING_BOX, OFFLINE, STOP_STORE, STOP_TTL,
+        fetch_stop, get_client, get_stop_clusters, get_stops
+    )
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    logger.info('Start')
+
+    if not STOP_STORE:
+        logger.error('STOP_STORE not set')
+        sys.exit(1)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == 'import' and len(sys.argv) == 3:
+        stops = load_fixture(sys.argv[2])
+        store = StopStore(STOP_STORE)
+        store.put(stops)
+        store.close()
+        logger.info('Imported %s stops from %s', len(stops), sys.argv[2])
+
+    elif command == 'refresh' and len(sys.argv) == 2:
+        if OFFLINE:
+            logger.error('Can\'t refresh the stop store while OFFLINE is set')
+            sys.exit(1)
+        client = get_client()
+        schema = client.get(API_SCHEMA)
+        get_stops(client, schema, BOUNDING_BOX, refresh=True)
+        store = StopStore(STOP_STORE)
+        expired = store.expired(STOP_TTL)
+        for code in expired:
+            stop = fetch_stop(client, schema, code)
+            if stop:
+                store.put([stop])
+        store.close()
+        logger.info('Refreshed %s expired stops', len(expired))
+        get_stop_clusters()
+
+    else:
+        logger.error('Usage: %s refresh | import FILE', sys.argv[0])
+        sys.exit(1)
+
+    logger.info('Stop')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+'''
+Persistent index of compiled TNDS timetable files
+
+TNDS files only change when refresh_timetable.sh retrieves a new copy
+of a region, but every run of get_journeys needs the services,
+operators, journey patterns, journey pattern sections and operating
+profiles they contain. This module keeps the compiled version of each
+file (as produced by get_journeys.load_timetable) in an SQLite database
+keyed by the file's path, so that only files that have changed since
+they were last seen need to be parsed again.
+
+TNDS files can either be loose files in a directory per region
+(TimetableFile) or members of the region's zip file as downloaded
+(ZipMember). A loose file is considered unchanged if its modification
+time matches the one recorded in the index or, failing that, if the
+SHA1 hash of its content does. A zip member is identified by its CRC
+and date.
+
+The index also holds a manifest of the stops used by each file, and in
+particular of the first and last stops of its journeys, so that files
+which can't contain any interesting journeys can be skipped without
+even loading them from the index.
+
+Run as a script, this brings the index up to date for all the files
+in TNDS_REGIONS, compiling only those whose content has changed, and
+reports the services that have been added, removed or modified. This
+is done by refresh_timetable.sh whenever the timetable changes.
+'''
+
+import glob
+import hashlib
+import io
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import zipfile
+
+logger = logging.getLogger('__name__')
+
+# Increment this when the structure returned by
+# get_journeys.load_timetable changes to invalidate existing indexes
+INDEX_FORMAT = 5
+
+
+class TimetableFile(object):
+    '''
+    A TNDS file stored as a file in a directory
+    '''
+
+    digest = None
+
+    def __init__(self, path):
+        self.name = path
+
+    def stamp(self):
+        return repr(os.stat(self.name).st_mtime)
+
+    def open(self):
+        return open(self.name, 'rb')
+
+
+# Open zip files, keyed by path and modification time
+_zip_files = {}
+
+
+def open_zip(path):
+    '''
+    Return a (cached) ZipFile for path
+    '''
+    key = (path, os.stat(path).st_mtime)
+    if key not in _zip_files:
+        _zip_files.clear()
+        _zip_files[key] = zipfile.ZipFile(path)
+    return _zip_files[key]
+
+
+class ZipMember(object):
+    '''
+    A TNDS file stored as a member of a zip file
+    '''
+
+    def __init__(self, path, info):
+        self.path = path
+        self.member = info.filename
+        self.name = os.path.join(path, info.filename)
+        self.digest = 'crc32:%08x' % info.CRC
+        self.date_time = '%04d-%02d-%02dT%02d:%02d:%02d' % info.date_time
+
+    def stamp(self):
+        return '%s %s' % (self.digest, self.date_time)
+
+    def open(self):
+        return open_zip(self.path).open(self.member)
+
+
+def region_sources(timetable_path, region, from_zip=False):
+    '''
+    Return the location of a region's TNDS files (a directory, or a
+    zip file if from_zip is True) and a list of TimetableFiles or
+    ZipMembers for the files it contains, sorted by name
+    '''
+    if from_zip:
+        location = os.path.join(timetable_path, region + '.zip')
+        sources = [
+            ZipMember(location, info) for info in open_zip(location).infolist()
+            if info.filename.endswith('.xml')
+        ]
+    else:
+        location = os.path.join(timetable_path, region)
+        sources = [TimetableFile(path) for path in glob.glob(os.path.join(location, '*.xml'))]
+    return location, sorted(sources, key=lambda source: source.name)
+
+
+class TimetableIndex(object):
+
+    def __init__(self, filename):
+
+        logger.debug('Opening timetable index %s', filename)
+        # Several get_journeys workers may share the index, so wait for
+        # locks and let readers proceed alongside a writer
+        self.connection = sqlite3.connect(filename, timeout=120)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != INDEX_FORMAT:
+            logger.info('Timetable index format %s != %s - rebuilding',
+                        version, INDEX_FORMAT)
+            self.connection.execute('DROP TABLE IF EXISTS timetable')
+            self.connection.execute('PRAGMA user_version = %d' % INDEX_FORMAT)
+
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS timetable ('
+            'path TEXT PRIMARY KEY, '
+            'stamp TEXT NOT NULL, '
+            'digest TEXT NOT NULL, '
+            'terminal_stops TEXT NOT NULL, '
+            'stops TEXT NOT NULL, '
+            'services TEXT NOT NULL, '
+            'data BLOB NOT NULL)')
+        self.connection.commit()
+
+        self.hits = self.misses = self.skips = 0
+
+    def manifest(self, source):
+        '''
+        Return the set of first and last stops of the journeys in
+        source, and the set of all the stops they use, or None if
+        the index doesn't have an up to date entry for source
+        '''
+
+        row = self.connection.execute(
+            'SELECT stamp, terminal_stops, stops FROM timetable WHERE path = ?',
+            (source.name, )).fetchone()
+
+        if row is None or row[0] != source.stamp():
+            return None
+
+        return set(row[1].split()), set(row[2].split())
+
+    def load(self, source, loader):
+        '''
+        Return the compiled timetable for a TimetableFile or ZipMember
+
+        Return the version from the index if the source hasn't changed,
+        otherwise call loader(name, stream) to compile it (where stream
+        is a binary file object containing the source's content) and
+        store the result. The result must include 'terminal_stops' and
+        'stops' sets for the file's manifest.
+        '''
+
+        return self.update(source, loader, True)[0]
+
+    def update(self, source, loader, want_timetable=False):
+        '''
+        Bring the index entry for source up to date
+
+        Return the compiled timetable (if want_timetable is True or
+        the source had to be compiled, otherwise None) and, if the
+        source had changed, the set of service codes that it previously
+        contained (empty if the source is new). If the source hadn't
+        changed this is None.
+        '''
+
+        stamp = source.stamp()
+
+        row = self.connection.execute(
+            'SELECT stamp, digest, services, %s FROM timetable WHERE path = ?'
+            % ('data' if want_timetable else 'NULL'),
+            (source.name, )).fetchone()
+
+        if row is not None and row[0] == stamp:
+            self.hits += 1
+            return (pickle.loads(row[3]) if want_timetable else None), None
+
+        # Zip members come with a CRC; files have to be read and hashed
+        if source.digest is not None:
+            digest = source.digest
+            stream = None
+        else:
+            with source.open() as xml_file:
+                content = xml_file.read()
+            digest = hashlib.sha1(content).hexdigest()
+            stream = io.BytesIO(content)
+
+        if row is not None and row[1] == digest:
+            logger.debug('%s touched but unchanged', source.name)
+            self.connection.execute(
+                'UPDATE timetable SET stamp = ? WHERE path = ?',
+                (stamp, source.name))
+            self.connection.commit()
+            self.hits += 1
+            return (pickle.loads(row[3]) if want_timetable else None), None
+
+        logger.debug('Compiling %s', source.name)
+        if stream is None:
+            with source.open() as stream:
+                timetable = loader(source.name, stream)
+        else:
+            timetable = loader(source.name, stream)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO timetable '
+            '(path, stamp, digest, terminal_stops, stops, services, data) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (source.name, stamp, digest,
+             ' '.join(sorted(timetable['terminal_stops'])),
+             ' '.join(sorted(timetable['stops'])),
+             ' '.join(sorted(timetable['services'])),
+             pickle.dumps(timetable, pickle.HIGHEST_PROTOCOL)))
+        self.connection.commit()
+        self.misses += 1
+        return timetable, (set(row[2].split()) if row is not None else set())
+
+    def refresh(self, location, sources, loader):
+        '''
+        Bring the index up to date for all the sources in location
+
+        Only sources whose content has changed are compiled again.
+        Return sets of the codes of the services that have been added,
+        removed, or modified in a changed source
+        '''
+
+        added = set()
+        removed = set()
+        modified = set()
+
+        for source in sources:
+            timetable, previous = self.update(source, loader)
+            if previous is None:
+                continue
+            current = set(timetable['services'])
+            added |= current - previous
+            removed |= previous - current
+            modified |= current & previous
+
+        removed |= self.prune(location, set(source.name for source in sources))
+
+        # Services that have moved from one file to another
+        moved = added & removed
+        modified |= moved
+        added -= moved
+        removed -= moved
+
+        return added, removed, modified
+
+    def prune(self, location, seen):
+        '''
+        Remove entries for files in location (a directory or zip file)
+        whose names are not in seen. Return the set of the codes of the
+        services they contained
+        '''
+
+        prefix = os.path.join(location, '')
+        stale = [
+            (path, services) for (path, services) in self.connection.execute(
+                'SELECT path, services FROM timetable WHERE substr(path, 1, ?) = ?',
+                (len(prefix), prefix))
+            if path not in seen
+        ]
+        self.connection.executemany(
+            'DELETE FROM timetable WHERE path = ?', [(path, ) for path, _ in stale])
+        self.connection.commit()
+        if stale:
+            logger.info('Removed %s deleted files from timetable index', len(stale))
+
+        removed = set()
+        for _, services in stale:
+            removed.update(services.split())
+        return removed
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def main():
+
+    # Imported here since get_journeys itself uses this module
+    from get_journeys import build_index
+    from util import TIMETABLE_INDEX, TNDS_REGIONS
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    logger.info('Start')
+
+    if not TIMETABLE_INDEX:
+        logger.error('TIMETABLE_INDEX not set')
+        sys.exit(1)
+
+    added, removed, modified = build_index(TIMETABLE_INDEX, TNDS_REGIONS)
+
+    for description, services in (('Added', added), ('Removed', removed), ('Modified', modified)):
+        for service in sorted(services):
+            logger.info('%s service %s', description, service)
+
+    logger.info('Stop')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+'''
+Compare trips' positions with journeys' timed stops
+
+A journey lists the stops it is timetabled to call at and when; a trip
+records where its vehicle actually was and when. score_matches() uses
+this to rank the trips in groups that matched more than one trip
+('1-*' and '*-*'), and to reject those that evidently weren't running
+the journey: typically a second vehicle that briefly, or wrongly,
+claimed to be.
+
+A trip passes a stop if one of its positions is within
+PASSING_DISTANCE of the stop and PASSING_TIME of the time the journey
+is timetabled to be there. The distances between every nearby position
+of every trip in a group and every stop of its journey are calculated
+at once, so the cost is bounded by the size of the group.
+
+stop_delays() uses the same calculation to find when a trip passed
+each of a journey's stops, and so how late it was at each of them.
+'''
+
+import functools
+import logging
+import math
+
+import isodate
+import numpy
+
+from merge import match_type
+from spatial import METRES_PER_DEGREE, stop_position
+from trip import Trip
+
+logger = logging.getLogger('__name__')
+
+# How close (metres) and how near the timetabled time (seconds) a
+# position has to be for the trip to have passed a stop
+PASSING_DISTANCE = 100
+PASSING_TIME = 30 * 60
+
+# Trips that pass fewer than this fraction of the number of stops
+# passed by the best trip in their group are rejected
+CLAIMANT_FRACTION = 0.5
+
+
+def journey_arrays(journey, stops):
+    '''
+    Return arrays of the (latitude, longitude) of each of a journey's
+    stops (NaN for those not in 'stops' or without a position) and of
+    the timestamps at which it's timetabled to be at them
+    '''
+
+    nowhere = (float('nan'), float('nan'))
+    positions = numpy.array(
+        [stop_position(stops.get(stop['StopPointRef'], {})) or nowhere
+         for stop in journey['stops']], dtype=numpy.float64).reshape(-1, 2)
+    times = numpy.array([parse_time(stop['time']) for stop in journey['stops']], dtype=numpy.int64)
+    return positions, times
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_time(time):
+    '''
+    Convert a journey stop's ISO 8601 time to epoch seconds (cached,
+    since the same times occur in many journeys)
+    '''
+    return int(isodate.parse_datetime(time).timestamp())
+
+
+def as_trips(trips, converted=None):
+    '''
+    Return a list of Trips from a list of Trips or trip dictionaries
+    (as read back from JSON). Given a dictionary 'converted', mapping
+    the id() of trip dictionaries to the Trips made from them, each
+    dictionary is only converted the first time it's seen, and added
+    to it.
+    '''
+
+    result = []
+    for trip in trips:
+        if not isinstance(trip, Trip):
+            if converted is None:
+                trip = Trip.from_dict(trip)
+            else:
+                if id(trip) not in converted:
+                    converted[id(trip)] = Trip.from_dict(trip)
+                trip = converted[id(trip)]
+        result.append(trip)
+    return result
+
+
+def trip_arrays(trips):
+    '''
+    Return the positions and timestamps of a list of trips (Trips or
+    trip dictionaries) end to end, and the start and end of each trip's
+    rows
+    '''
+
+    trips = as_trips(trips)
+    lengths = numpy.array([len(trip) for trip in trips], dtype=numpy.int64)
+    ends = numpy.cumsum(lengths)
+    starts = ends - lengths
+    positions = numpy.column_stack((
+        numpy.concatenate([trip.latitude for trip in trips]),
+        numpy.concatenate([trip.longitude for trip in trips])))
+    timestamps = numpy.concatenate([trip.timestamp for trip in trips])
+    return positions, timestamps, starts, ends
+
+
+def passing(journey, trips, stops):
+    '''
+    Return arrays with a row for each of the positions of 'trips' end
+    to end and a column for each of the journey's stops: the distance
+    from each position to each stop in metres, the difference in
+    seconds between each position's time and each stop's timetabled
+    time, and whether the position counts as passing the stop. Also
+    return the start and end of each trip's rows.
+
+    Only positions inside the bounding box of the journey's stops
+    (widened by PASSING_DISTANCE) and within PASSING_TIME of its
+    timetable can pass any of them, so distances are only calculated
+    for those; the rest are infinite. Over these distances the
+    equirectangular approximation is as good as the haversine formula
+    and much quicker.
+    '''
+
+    stop_positions, stop_times = journey_arrays(journey, stops)
+    positions, timestamps, starts, ends = trip_arrays(trips)
+
+    distance = numpy.full((len(positions), len(stop_positions)), numpy.inf)
+    known = ~numpy.isnan(stop_positions).any(axis=1)
+    if len(positions) and known.any():
+        low = stop_positions[known].min(axis=0)
+        high = stop_positions[known].max(axis=0)
+        scale = numpy.array((METRES_PER_DEGREE, METRES_PER_DEGREE * math.cos(math.radians(high[0]))))
+        margin = PASSING_DISTANCE / scale
+        candidates = numpy.flatnonzero(
+            ((positions >= low - margin) & (positions <= high + margin)).all(axis=1) &
+            (timestamps >= stop_times.min() - PASSING_TIME) &
+            (timestamps <= stop_times.max() + PASSING_TIME))
+        if len(candidates):
+            here = positions[candidates] * scale
+            there = stop_positions * scale
+            distance[candidates] = numpy.hypot(
+                here[:, 0, numpy.newaxis] - there[numpy.newaxis, :, 0],
+                here[:, 1, numpy.newaxis] - there[numpy.newaxis, :, 1])
+    offset = timestamps[:, numpy.newaxis] - stop_times[numpy.newaxis, :]
+    near = (distance <= PASSING_DISTANCE) & (numpy.abs(offset) <= PASSING_TIME)
+
+    return distance, offset, near, starts, ends
+
+
+def score_trips(journey, trips, stops):
+    '''
+    Return a score for each trip against journey: a dictionary of the
+    number of the journey's stops that it passed ('passed'), the number
+    of stops ('stops') and the mean absolute difference in seconds
+    between the timetabled times and the nearest in time of the
+    positions passing each stop ('error', None if it passed none)
+    '''
+
+    _, offset, near, starts, ends = passing(journey, trips, stops)
+    error = numpy.where(near, numpy.abs(offset), numpy.iinfo(numpy.int64).max)
+
+    scores = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        passed = near[start:end].any(axis=0)
+        closest = error[start:end].min(axis=0, initial=numpy.iinfo(numpy.int64).max)
+        scores.append({
+            'passed': int(passed.sum()),
+            'stops': len(journey['stops']),
+            'error': int(closest[passed].mean().round()) if passed.any() else None,
+        })
+    return scores
+
+
+def stop_delays(journey, trip, stops):
+    '''
+    Return a list of the delay in seconds at each of a journey's stops
+    observed from trip: the time of the trip's position nearest the
+    stop, of those passing it, less the timetabled time, or None if
+    none of its positions passed the stop
+    '''
+
+    distance, offset, near, _, _ = passing(journey, [trip], stops)
+    if not len(distance):
+        return [None] * len(journey['stops'])
+
+    columns = numpy.arange(distance.shape[1])
+    nearest = numpy.where(near, distance, numpy.inf).argmin(axis=0)
+    delays = offset[nearest, columns]
+    passed = near[nearest, columns]
+
+    return [delay if found else None for delay, found in zip(delays.tolist(), passed.tolist())]
+
+
+def score_matches(merged, stops, converted=None):
+    '''
+    Score the trips in each merged group with more than one trip
+    against the group's journeys, order them best first (most stops
+    passed, then smallest error) and move those passing fewer than
+    CLAIMANT_FRACTION as many stops as the best to 'rejected'
+
+    Each group's scores are stored in 'scores' (and those of rejected
+    trips in 'rejected_scores') in the same order as its trips, and its
+    type is updated to reflect any trips rejected. Groups that already
+    have scores are left alone. 'stops' is a dictionary of stops keyed
+    by ATCOCode, as from extract_stops.lookup_stops(). Trip
+    dictionaries are converted to Trips once per group, or just once
+    given a dictionary 'converted' (see as_trips()) that is shared with
+    expand_merged.expand().
+    '''
+
+    groups = [merge for merge in merged
+              if merge['journeys'] and len(merge['trips']) > 1 and 'scores' not in merge]
+    logger.info('Scoring the trips in %s groups', len(groups))
+
+    rejected = 0
+    for merge in groups:
+
+        # Each trip's best score against any of the journeys
+        trips = as_trips(merge['trips'], converted)
+        best = None
+        for journey in merge['journeys']:
+            scores = score_trips(journey, trips, stops)
+            if best is None:
+                best = scores
+            else:
+                best = [max(a, b, key=rank) for a, b in zip(best, scores)]
+
+        ranked = sorted(zip(merge['trips'], best), key=lambda pair: rank(pair[1]), reverse=True)
+        threshold = ranked[0][1]['passed'] * CLAIMANT_FRACTION
+        kept = [pair for pair in ranked if pair[1]['passed'] >= threshold]
+        dropped = [pair for pair in ranked if pair[1]['passed'] < threshold]
+
+        merge['trips'] = [trip for trip, _ in kept]
+        merge['scores'] = [score for _, score in kept]
+        merge['rejected'] = [trip for trip, _ in dropped]
+        merge['rejected_scores'] = [score for _, score in dropped]
+        merge['type'] = match_type(merge['journeys'], merge['trips'])
+        rejected += len(dropped)
+
+        logger.debug('%s at %s: passed %s, rejected %s',
+                     merge['journeys'][0]['stops'][0]['StopPointRef'],
+                     merge['journeys'][0]['DepartureTime'],
+                     [score['passed'] for score in merge['scores']],
+                     [score['passed'] for score in merge['rejected_scores']])
+
+    logger.info('Rejected %s trips', rejected)
+
+
+def rank(score):
+    '''
+    Sort key for scores, larger being better
+    '''
+    return (score['passed'], -score['error'] if score['error'] is not None else float('-inf'))
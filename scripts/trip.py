@@ -0,0 +1,321 @@
+'''
+Compact in-memory representation of a vehicle trip
+
+A trip collected from SIRI-VM data can have hundreds of position
+reports. Rather than keeping each as a dictionary of strings, a Trip
+keeps them as typed NumPy arrays (one per field) alongside the fields
+that are common to the whole trip, and only turns them back into the
+usual JSON structure (see as_dict()) when the trip is output.
+
+Trips can still be indexed like the dictionaries they replace, so
+trip['LineRef'], trip['positions'][n]['RecordedAtTime'] and so on
+continue to work, though it's faster to use the arrays directly.
+'''
+
+import array
+import datetime
+import functools
+import logging
+
+import isodate
+import numpy
+import pytz
+
+logger = logging.getLogger('__name__')
+
+UK_LOCAL = pytz.timezone('Europe/London')
+
+# Fields that are common to all the positions in a trip...
+TRIP_FIELDS = (
+    'DestinationName', 'DestinationRef', 'DirectionRef', 'LineRef',
+    'OperatorRef', 'OriginAimedDepartureTime', 'OriginName',
+    'OriginRef', 'VehicleRef'
+)
+
+# ... and the data that makes up a position report
+POSITION_FIELDS = (
+    'Bearing', 'Delay', 'Latitude', 'Longitude', 'RecordedAtTime'
+)
+
+# Stored in place of a missing or unparsable bearing
+NO_BEARING = -1
+
+# ... and of a missing or unparsable delay
+NO_DELAY = numpy.iinfo(numpy.int32).min
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_delay(delay):
+    '''
+    Convert a SIRI-VM Delay (an ISO 8601 duration such as '-PT33S') to
+    whole seconds, or NO_DELAY if it can't be
+    '''
+    try:
+        return int(isodate.parse_duration(delay).total_seconds())
+    except (isodate.ISO8601Error, ValueError, TypeError, AttributeError):
+        logger.warning('Invalid Delay %r', delay)
+        return NO_DELAY
+
+
+def format_delay(seconds):
+    '''
+    Convert whole seconds back to a SIRI-VM style Delay ('' for
+    NO_DELAY)
+    '''
+    if seconds == NO_DELAY:
+        return ''
+    sign = '-' if seconds < 0 else ''
+    hours, rest = divmod(abs(int(seconds)), 3600)
+    minutes, seconds = divmod(rest, 60)
+    result = sign + 'PT'
+    if hours:
+        result += '%dH' % hours
+    if minutes:
+        result += '%dM' % minutes
+    if seconds or not (hours or minutes):
+        result += '%dS' % seconds
+    return result
+
+
+def parse_bearing(bearing):
+    try:
+        return int(float(bearing)) % 360
+    except (TypeError, ValueError):
+        return NO_BEARING
+
+
+def format_time(timestamp):
+    '''
+    Convert epoch seconds to an ISO 8601 time in UK local time
+    '''
+    return datetime.datetime.fromtimestamp(int(timestamp), UK_LOCAL).isoformat()
+
+
+class Positions(object):
+    '''
+    Read-only sequence of a Trip's positions as dictionaries
+    '''
+
+    def __init__(self, trip):
+        self.trip = trip
+
+    def __len__(self):
+        return len(self.trip.timestamp)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        return self.trip.position(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.trip.position(index)
+
+
+class Trip(object):
+    '''
+    A vehicle trip with its positions held in NumPy arrays:
+    latitude and longitude (float64), timestamp (int64 epoch
+    seconds, from acp_ts), bearing (int16 degrees, NO_BEARING if
+    unknown) and delay (int32 seconds, NO_DELAY if unknown)
+
+    While positions are being added the arrays may be Python
+    array.arrays; finish() converts them and sorts them by time.
+
+    SIRI-VM snapshots often repeat a vehicle's last report, so a
+    position with the same time, latitude and longitude as the one
+    added before it is dropped (and counted in 'duplicates'). Since
+    a trip has a single VehicleRef this removes repeated reports
+    using no more memory than the trip's last position.
+    '''
+
+    __slots__ = TRIP_FIELDS + (
+        'OriginStop', 'DestinationStop',
+        'departure_position', 'arrival_position',
+        'latitude', 'longitude', 'timestamp', 'bearing', 'delay',
+        'duplicates',
+    )
+
+    def __init__(self, record):
+        for field in TRIP_FIELDS:
+            setattr(self, field, record[field])
+        self.OriginStop = self.DestinationStop = None
+        self.departure_position = self.arrival_position = None
+        self.latitude = array.array('d')
+        self.longitude = array.array('d')
+        self.timestamp = array.array('q')
+        self.bearing = array.array('h')
+        self.delay = array.array('i')
+        self.duplicates = 0
+
+    @classmethod
+    def from_dict(cls, trip):
+        '''
+        Make a (finished) Trip from a trip in its JSON form
+        '''
+        result = cls(trip)
+        for field in ('OriginStop', 'DestinationStop', 'departure_position', 'arrival_position'):
+            setattr(result, field, trip.get(field))
+        positions = trip['positions']
+        result.latitude = numpy.array([float(p['Latitude']) for p in positions], dtype=numpy.float64)
+        result.longitude = numpy.array([float(p['Longitude']) for p in positions], dtype=numpy.float64)
+        result.timestamp = numpy.array(
+            [int(isodate.parse_datetime(p['RecordedAtTime']).timestamp()) for p in positions],
+            dtype=numpy.int64)
+        result.bearing = numpy.array([parse_bearing(p['Bearing']) for p in positions], dtype=numpy.int16)
+        result.delay = numpy.array([parse_delay(p['Delay']) for p in positions], dtype=numpy.int32)
+        return result
+
+    @classmethod
+    def from_columns(cls, fields, latitude, longitude, timestamp, bearing, delay, duplicates=0):
+        '''
+        Make an (unfinished) Trip from a dictionary of TRIP_FIELDS and
+        arrays of position data
+        '''
+        result = cls(fields)
+        result.duplicates = duplicates
+        result.latitude = latitude
+        result.longitude = longitude
+        result.timestamp = timestamp
+        result.bearing = bearing
+        result.delay = delay
+        return result
+
+    def add(self, record):
+        '''
+        Add the position from a SIRI-VM record, unless it repeats the
+        last one
+        '''
+        latitude = float(record['Latitude'])
+        longitude = float(record['Longitude'])
+        timestamp = int(record['acp_ts'])
+        if (len(self.timestamp) and timestamp == self.timestamp[-1] and
+                latitude == self.latitude[-1] and longitude == self.longitude[-1]):
+            self.duplicates += 1
+            return
+        self.latitude.append(latitude)
+        self.longitude.append(longitude)
+        self.timestamp.append(timestamp)
+        self.bearing.append(parse_bearing(record['Bearing']))
+        self.delay.append(parse_delay(record['Delay']))
+
+    def extend(self, other):
+        '''
+        Add the positions of another (unfinished) part of this trip,
+        collected from the files that follow those of this one
+        '''
+        self.duplicates += other.duplicates
+        # The other part may start with a repeat of this one's last
+        # position
+        skip = int(len(self.timestamp) > 0 and len(other.timestamp) > 0 and
+                   other.timestamp[0] == self.timestamp[-1] and
+                   other.latitude[0] == self.latitude[-1] and
+                   other.longitude[0] == self.longitude[-1])
+        self.duplicates += skip
+        if not isinstance(self.latitude, array.array):
+            self.latitude = array.array('d', self.latitude)
+            self.longitude = array.array('d', self.longitude)
+            self.timestamp = array.array('q', self.timestamp)
+            self.bearing = array.array('h', self.bearing)
+            self.delay = array.array('i', self.delay)
+        self.latitude.extend(other.latitude[skip:])
+        self.longitude.extend(other.longitude[skip:])
+        self.timestamp.extend(other.timestamp[skip:])
+        self.bearing.extend(other.bearing[skip:])
+        self.delay.extend(other.delay[skip:])
+
+    def finish(self):
+        '''
+        Convert the positions to NumPy arrays sorted by time. Positions
+        with the same time keep the order in which they were added.
+        '''
+        timestamp = numpy.asarray(self.timestamp, dtype=numpy.int64)
+        order = numpy.argsort(timestamp, kind='stable')
+        self.timestamp = timestamp[order]
+        self.latitude = numpy.asarray(self.latitude, dtype=numpy.float64)[order]
+        self.longitude = numpy.asarray(self.longitude, dtype=numpy.float64)[order]
+        self.bearing = numpy.asarray(self.bearing, dtype=numpy.int16)[order]
+        self.delay = numpy.asarray(self.delay, dtype=numpy.int32)[order]
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    @property
+    def bbox(self):
+        '''
+        [min longitude, min latitude, max longitude, max latitude]
+        '''
+        if len(self) == 0:
+            return [None, None, None, None]
+        return [float(numpy.min(self.longitude)), float(numpy.min(self.latitude)),
+                float(numpy.max(self.longitude)), float(numpy.max(self.latitude))]
+
+    @property
+    def positions(self):
+        return Positions(self)
+
+    def recorded_at(self, index):
+        '''
+        Return the time of position 'index' as an aware datetime
+        '''
+        return datetime.datetime.fromtimestamp(int(self.timestamp[index]), UK_LOCAL)
+
+    def position(self, index):
+        '''
+        Return position 'index' in its original JSON form
+        '''
+        bearing = int(self.bearing[index])
+        return {
+            'Bearing': str(bearing) if bearing != NO_BEARING else '',
+            'Delay': format_delay(self.delay[index]),
+            'Latitude': '%.7f' % self.latitude[index],
+            'Longitude': '%.7f' % self.longitude[index],
+            'RecordedAtTime': format_time(self.timestamp[index]),
+        }
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def as_dict(self):
+        '''
+        Return the trip in its original JSON form
+        '''
+        result = {field: getattr(self, field) for field in TRIP_FIELDS}
+        result['OriginStop'] = self.OriginStop
+        result['DestinationStop'] = self.DestinationStop
+        result['positions'] = list(self.positions)
+        result['bbox'] = [None if value is None else '%.7f' % value for value in self.bbox]
+        result['departure_position'] = self.departure_position
+        result['arrival_position'] = self.arrival_position
+        return result
+
+
+def json_default(o):
+    '''
+    'default' function for json.dump() that serializes Trips
+    '''
+    if isinstance(o, Trip):
+        return o.as_dict()
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+def recorded_at(trip, index):
+    '''
+    Return the time of position 'index' of a trip, either a Trip or
+    a trip dictionary as read back from JSON
+    '''
+    if isinstance(trip, Trip):
+        return trip.recorded_at(index)
+    return isodate.parse_datetime(trip['positions'][index]['RecordedAtTime'])
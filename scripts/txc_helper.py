@@ -107,6 +107,49 @@ class DateRange(object):
         return "%s->%s" % (str(self.start), str(self.end))
 
 
+class DayMask(object):
+    '''
+    The days on which an OperatingProfile operates, as compiled by
+    OperatingProfile.compile(). Days from start up to and including
+    the last date of any significance to the profile are held in an
+    array with one entry per day. Where the operating period is
+    open-ended, later days depend only on the day of the week and
+    are held in 'weekly'
+    '''
+    def __init__(self, start, days, weekly):
+        self.start = start
+        self.days = days
+        self.weekly = weekly
+
+    def __contains__(self, date):
+        offset = (date - self.start).days
+        if offset < 0:
+            return False
+        if offset < len(self.days):
+            return bool(self.days[offset])
+        if self.weekly is not None:
+            return self.weekly[date.weekday()]
+        return False
+
+    def dates(self, start, end):
+        '''
+        Yield every date from start to end inclusive on which the
+        profile operates
+        '''
+        date = max(start, self.start)
+        while date <= end:
+            if date in self:
+                yield date
+            date += datetime.timedelta(days=1)
+
+    def __repr__(self):
+        return "DayMask(%s, %s days, %s)" % (self.start, len(self.days), self.weekly)
+
+
+# Compiled DayMasks, keyed by OperatingProfile content and operating period
+_compiled = {}
+
+
 class OperatingProfile(object):
     def __init__(self):
 
@@ -255,6 +298,65 @@ class OperatingProfile(object):
         return False
 
 
+    def key(self):
+        '''
+        Return a hashable representation of this object's content
+        '''
+        return (
+            tuple(day.day if isinstance(day, DayOfWeek) else day for day in self.regular_days),
+            tuple((r.start, r.end) for r in self.nonoperation_days),
+            tuple((r.start, r.end) for r in self.operation_days),
+            tuple(self.nonoperation_bank_holidays),
+            tuple(self.operation_bank_holidays),
+        )
+
+
+    def compile(self, start, end=None):
+        '''
+        Return a DayMask identifying the days from start to end (or
+        indefinitely if end is None) on which an entity with this
+        OperatingProfile runs, so that should_show() doesn't have to
+        be re-evaluated for each day. Results are shared between
+        profiles with the same content.
+        '''
+
+        key = (self.key(), start, end)
+        if key in _compiled:
+            return _compiled[key]
+
+        # Beyond the last bank holiday and the last explicit date range
+        # the answer only depends on the day of the week
+        if end is None:
+            last = max([start, max(BANK_HOLIDAYS)] +
+                       [r.end for r in self.nonoperation_days + self.operation_days])
+            weekly = [None] * 7
+        else:
+            last = end
+            weekly = None
+
+        # Real data includes operating periods that end before they
+        # start: these never operate
+        if last < start:
+            mask = DayMask(start, bytearray(), None)
+            _compiled[key] = mask
+            return mask
+
+        days = bytearray((last - start).days + 1)
+        for offset in range(len(days)):
+            days[offset] = self.should_show(start + datetime.timedelta(days=offset))
+
+        if weekly is not None:
+            date = last + datetime.timedelta(days=1)
+            for offset in range(7):
+                weekly[date.weekday()] = self.should_show(date)
+                date += datetime.timedelta(days=1)
+            weekly = tuple(weekly)
+
+        mask = DayMask(start, days, weekly)
+        _compiled[key] = mask
+        return mask
+
+
     def defaults_from(self, defaults):
         '''
         Update this object from a second one containing defaults
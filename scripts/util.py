@@ -1,33 +1,131 @@
 
+import concurrent.futures
 import coreapi
 import logging
 import os
+import sqlite3
+import urllib.parse
+
+import requests
+
+from spatial import Area, StopIndex, stop_clusters
+from stop_store import StopStore
 
 logger = logging.getLogger('__name__')
 
 # Where to find the real-time data
 LOAD_PATH = os.getenv('SIRIVM_PATH', '/media/tfc/sirivm_json/data_bin/')
 
+# Where to keep consolidated daily archives of the real-time data
+# (empty to disable)
+SIRIVM_ARCHIVE_PATH = os.getenv(
+    'SIRIVM_ARCHIVE_PATH', '/media/tfc/cam_tt_matching/sirivm_archive/')
+
+# Number of processes to use when reading real-time data
+SIRIVM_WORKERS = int(os.getenv('SIRIVM_WORKERS', '1'))
+
 # Where to find the timetable data
 TIMETABLE_PATH = os.getenv('TIMETABLE_PATH', '/media/tfc/tnds/sections/')
 
+# Read timetable data from unpacked directories ('directory') or
+# directly from the downloaded zip files ('zip')
+TIMETABLE_SOURCE = os.getenv('TIMETABLE_SOURCE', 'directory')
+
+# Where to keep the compiled timetable index (empty to disable)
+TIMETABLE_INDEX = os.getenv(
+    'TIMETABLE_INDEX', os.path.join(TIMETABLE_PATH, 'index.sqlite'))
+
 # Where to find the TFC API schema
 API_SCHEMA = os.getenv('API_SCHEMA', 'https://smartcambridge.org/api/docs/')
 
-# Default is roughly Bar Hill <-> Fulbourn
-BOUNDING_BOX = os.getenv('BOUNDING_BOX', '0.007896,52.155610,0.225048,52.267842')
+# Base URL of the SmartCambridge API itself, for stop lookups made
+# directly rather than through the schema
+API_BASE = os.getenv('API_BASE', 'https://smartcambridge.org/api/v1/')
+
+# Maximum number of stop lookups to have in progress at once
+LOOKUP_WORKERS = int(os.getenv('LOOKUP_WORKERS', '8'))
+
+# Match trips to journeys whose departure times differ by up to
+# this many seconds, if they don't match exactly
+MERGE_TOLERANCE = int(os.getenv('MERGE_TOLERANCE', '0'))
+
+# Optionally, a JSON file containing a list of lists of stops that
+# are to be treated as equivalent when matching trips to journeys
+MERGE_EQUIVALENT_STOPS = os.getenv('MERGE_EQUIVALENT_STOPS', '')
+
+# Optionally, match trips to journeys whose stops are in the same
+# NaPTAN stop area or within this many metres of each other (0 for
+# stop areas only)
+MERGE_CLUSTER_RADIUS = (float(os.getenv('MERGE_CLUSTER_RADIUS'))
+                        if os.getenv('MERGE_CLUSTER_RADIUS') else None)
+
+# Optionally, a GeoJSON file containing the polygon(s) within which
+# trips and journeys must start or end
+AREA = Area.from_geojson(os.getenv('AREA')) if os.getenv('AREA') else None
+
+# Default is roughly Bar Hill <-> Fulbourn, or the extent of AREA
+BOUNDING_BOX = os.getenv(
+    'BOUNDING_BOX', AREA.bounding_box if AREA else '0.007896,52.155610,0.225048,52.267842')
 
 # TNDS regious to process
 TNDS_REGIONS = os.getenv('TNDS_REGIONS', 'EA SE').split()
 
+# Number of processes to use when parsing TNDS files
+TNDS_WORKERS = int(os.getenv('TNDS_WORKERS', '1'))
+
+# Where to keep retrieved stop details between runs (empty to disable)
+STOP_STORE = os.getenv('STOP_STORE', '/media/tfc/cam_tt_matching/stops.sqlite')
+
+# How long stored stop details remain valid (days, converted to seconds)
+STOP_TTL = float(os.getenv('STOP_TTL', '7')) * 24 * 60 * 60
+
+# Never use the network: take stop details only from STOP_STORE
+OFFLINE = os.getenv('OFFLINE', '') not in ('', '0')
+
 API_TOKEN = os.getenv('API_TOKEN', None)
-assert API_TOKEN, 'API_TOKEN environment variable not set'
+assert API_TOKEN or OFFLINE, 'API_TOKEN environment variable not set'
+
+
+class OfflineClient(object):
+    '''
+    Stand-in for a coreapi client for use when OFFLINE is set
+    '''
+
+    def get(self, url):
+        return None
+
+    def action(self, schema, action, params=None):
+        raise RuntimeError('Attempt to use the API while OFFLINE is set')
+
+
+# The StopStore, once opened
+_stop_store = None
+
+
+def stop_store():
+    '''
+    Return the StopStore, or None if STOP_STORE isn't set or can't
+    be opened
+    '''
+    global _stop_store
+    if not STOP_STORE:
+        return None
+    if _stop_store is None:
+        try:
+            _stop_store = StopStore(STOP_STORE)
+        except sqlite3.Error as e:
+            logger.warning('Can\'t open stop store %s (%s) - not using it', STOP_STORE, e)
+            _stop_store = False
+    return _stop_store or None
 
 
 def get_client():
     '''
-    Return a coreapi client instance initialised with an access token.
+    Return a coreapi client instance initialised with an access token,
+    or an OfflineClient if OFFLINE is set.
     '''
+    if OFFLINE:
+        return OfflineClient()
     auth = coreapi.auth.TokenAuthentication(
         scheme='Token',
         token=API_TOKEN
@@ -36,12 +134,41 @@ def get_client():
     return client
 
 
-def get_stops(client, schema, bounding_box):
+def get_stops(client, schema, bounding_box, refresh=False, area=AREA):
     '''
     Return a dictionary of all bus stops that fall inside the
-    bounding_box. The dictionary key is the stop ATCOCode and
-    the content of the information record returned by the API.
+    bounding_box, and inside 'area' (an Area, by default AREA) if
+    given. The dictionary key is the stop ATCOCode and the content of
+    the information record returned by the API.
+
+    The stops are taken from the stop store if it has them all and
+    they haven't expired (or OFFLINE is set) unless 'refresh' is True.
     '''
+    stops = get_stops_in_box(client, schema, bounding_box, refresh)
+    if area is not None:
+        stops = StopIndex(stops).in_area(area)
+        logger.info('%s stops are in the area', len(stops))
+    return stops
+
+
+def get_stops_in_box(client, schema, bounding_box, refresh=False):
+    '''
+    Return a dictionary of all bus stops that fall inside the
+    bounding_box (see get_stops())
+    '''
+    store = stop_store()
+    if store is not None and not refresh:
+        stops = store.area(bounding_box, None if OFFLINE else STOP_TTL)
+        if stops is None and OFFLINE:
+            logger.warning('Stops in %s not stored - using any stored stops that are', bounding_box)
+            stops = store.stops_in(bounding_box)
+        if stops is not None:
+            logger.info('Retrieved %s stops in %s from the stop store', len(stops), bounding_box)
+            return stops
+    if OFFLINE:
+        logger.error('Can\'t get stops in %s while OFFLINE is set', bounding_box)
+        return {}
+
     logger.info("Getting stops in %s", bounding_box)
     stops = {}
     action = ['transport', 'stops', 'list']
@@ -57,9 +184,35 @@ def get_stops(client, schema, bounding_box):
             break
         page += 1
     logger.info('Retrieved %s stops.', len(stops))
+    if store is not None:
+        store.put_area(bounding_box, stops)
     return stops
 
 
+def get_stop_clusters(radius=MERGE_CLUSTER_RADIUS):
+    '''
+    Return a dictionary mapping the ATCOCode of each stop in the stop
+    store to the id of its cluster (see spatial.stop_clusters()), or
+    an empty one if radius is None or there is no stop store
+
+    The clusters are built from all the stored stops, and stored
+    with them until the stops change.
+    '''
+    if radius is None:
+        return {}
+    store = stop_store()
+    if store is None:
+        logger.warning('Stop clusters need a stop store - not using them')
+        return {}
+    clusters = store.clusters(radius)
+    if clusters is None:
+        clusters = stop_clusters(store.stops(), radius)
+        store.put_clusters(radius, clusters)
+        logger.info('Built %s clusters of %s stops within %sm',
+                    len(set(clusters.values())), len(clusters), radius)
+    return clusters
+
+
 def update_bbox(box, lng, lat):
     '''
     Update a bounding box
@@ -78,26 +231,127 @@ def update_bbox(box, lng, lat):
         box[3] = lat
 
 
+def fetch_stop(client, schema, stop):
+    '''
+    Get details of a bus stop by ATCOCode from the API, or {} if
+    that fails
+    '''
+    try:
+        action = ['transport', 'stop', 'read']
+        params = {'atco_code': stop}
+        logger.debug("Getting stop details for %s", stop)
+        return client.action(schema, action, params=params)
+    except coreapi.exceptions.ErrorMessage as e:
+        logger.error("Failed to lookup stop %s: %s", stop, e)
+        return {}
+
+
+# Stops that couldn't be looked up, so aren't tried again
+_failed_stops = set()
+
+# Keep-alive HTTP session for prefetch_stops(), with a connection
+# for each of its threads
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=LOOKUP_WORKERS)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session.headers['Authorization'] = 'Token %s' % API_TOKEN
+        _session.headers['Accept'] = 'application/json'
+    return _session
+
+
+def _fetch_stop(stop):
+    url = urllib.parse.urljoin(API_BASE, 'transport/stop/%s/' % urllib.parse.quote(stop))
+    try:
+        response = get_session().get(url, timeout=30)
+        response.raise_for_status()
+        return response.json()
+    except (requests.RequestException, ValueError) as e:
+        logger.error("Failed to lookup stop %s: %s", stop, e)
+        return {}
+
+
+def prefetch_stops(stops, stops1, stops2):
+    '''
+    Lookup details of many bus stops by ATCOCode
+
+    Make sure that all of 'stops' are in stops1 or stops2 (as lookup()
+    would), retrieving any that aren't already known or in the stop
+    store from API_BASE, LOOKUP_WORKERS at a time over keep-alive
+    connections. Stops that can't be retrieved are cached in stops2
+    as {}, and aren't tried again.
+    '''
+
+    wanted = sorted(set(stops) - set(stops1) - set(stops2))
+
+    store = stop_store()
+    missing = []
+    for stop in wanted:
+        result = {} if stop in _failed_stops else None
+        if result is None and store is not None:
+            result = store.get(stop, None if OFFLINE else STOP_TTL)
+        if result is None:
+            missing.append(stop)
+        else:
+            stops2[stop] = result
+
+    if not missing:
+        return
+    if OFFLINE:
+        logger.error("%s stops not stored and OFFLINE is set", len(missing))
+        for stop in missing:
+            stops2[stop] = {}
+        return
+
+    logger.info('Looking up %s stops', len(missing))
+    with concurrent.futures.ThreadPoolExecutor(LOOKUP_WORKERS) as executor:
+        results = list(executor.map(_fetch_stop, missing))
+
+    for stop, result in zip(missing, results):
+        stops2[stop] = result
+        if not result:
+            _failed_stops.add(stop)
+    if store is not None:
+        store.put([result for result in results if result])
+
+
 def lookup(client, schema, stop, stops1, stops2):
     '''
     Lookup details of a bus stop by ATCOCode
 
-    Find stop details in stops1 or in stops2, and failing that
-    get the details via the client and cache the result in stops2
+    Find stop details in stops1 or in stops2, then in the stop store,
+    and failing that get the details via the client (unless OFFLINE is
+    set). Cache the result in stops2, and in the stop store if it came
+    from the API
     '''
 
     if stop in stops1:
         return stops1[stop]
     if stop in stops2:
         return stops2[stop]
-    try:
-        action = ['transport', 'stop', 'read']
-        params = {'atco_code': stop}
-        logger.debug("Getting stop details for %s", stop)
-        result = client.action(schema, action, params=params)
-    except coreapi.exceptions.ErrorMessage as e:
-        logger.error("Failed to lookup stop %s: %s", stop, e)
-        result = {}
+    if stop in _failed_stops:
+        return {}
+
+    store = stop_store()
+    result = None
+    if store is not None:
+        result = store.get(stop, None if OFFLINE else STOP_TTL)
+    if result is None:
+        if OFFLINE:
+            logger.error("Stop %s not stored and OFFLINE is set", stop)
+            result = {}
+        else:
+            result = fetch_stop(client, schema, stop)
+            if not result:
+                _failed_stops.add(stop)
+            elif store is not None:
+                store.put([result])
 
-    stops2[result['atco_code']] = result
+    stops2[result.get('atco_code', stop)] = result
     return result
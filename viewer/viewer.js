@@ -71,7 +71,7 @@ function init(){
                 alert(`Failed to get trip/journey data for ${date} - status ${xhr1.status}`);
             }
             else {
-                data = JSON.parse(xhr1.responseText);
+                data = resolve_rows(JSON.parse(xhr1.responseText));
                 ++requests_done;
                 if (requests_done >= 2) {
                     setup();
@@ -102,6 +102,22 @@ function init(){
 
 }
 
+// Replace the journey and trip ids in each row with the journeys and
+// trips they refer to (older files already have them in place)
+function resolve_rows(row_data) {
+    if (row_data.journeys) {
+        row_data.rows.forEach(function(row) {
+            if (row.journey !== null) {
+                row.journey = row_data.journeys[row.journey];
+            }
+            if (row.trip !== null) {
+                row.trip = row_data.trips[row.trip];
+            }
+        });
+    }
+    return row_data;
+}
+
 // Setup the table and the map
 function setup() {
     draw_map();
@@ -189,7 +205,7 @@ function draw_table() {
 
         add_heading(trow, counter+1);
 
-        add_data(trow, row.type);
+        add_data(trow, row.rejected ? row.type + ' (rejected)' : row.type);
         var timestamp = moment(row.time);
         add_data(trow, timestamp.format("YYYY-MM-DD"));
         add_data(trow, timestamp.format("HH:mm"));